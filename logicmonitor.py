@@ -18,21 +18,55 @@
    Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA"""
 
 try:
+    import atexit
+    import base64
+    import cProfile
+    import errno
+    import fcntl
+    import gc
+    import hashlib
+    import hmac
+    import httplib
     import json
     import logging
+    import mmap
     import os
     import platform
+    import pstats
+    import Queue
+    import random
+    import re
+    import resource
     import socket
+    import ssl
+    from cStringIO import StringIO
     import subprocess
     import sys
+    import tempfile
+    import threading
+    import time
     import urllib
     import urllib2
+    import urlparse
     from datetime import datetime, timedelta
+    from email.utils import mktime_tz, parsedate_tz
     from subprocess import Popen
+
+    # Python 2.7.9 and later check the certificates of HTTPS connections
+    VERIFIES_CERTS = hasattr(ssl, "create_default_context")
     HAS_LIB = True
 except:
     HAS_LIB = False
 
+# Prefer a faster JSON decoder when one is installed
+try:
+    from ujson import loads as json_loads
+except ImportError:
+    try:
+        from simplejson import loads as json_loads
+    except ImportError:
+        json_loads = json.loads
+
 RETURN = '''
 ---
 success:
@@ -40,6 +74,141 @@ success:
     returned: success
     type: boolean
     sample: True
+rpc:
+    description: >
+        RPC calls made by the task; in total, by action (with median and
+        95th percentile latency in seconds) and by the public method which
+        made them. hits are calls answered from a cache, rejected calls which
+        failed before any request was sent (by the circuit breaker or the
+        deadline), bytes the size of responses received and time the
+        seconds spent waiting on calls
+    returned: success
+    type: dictionary
+    sample:
+        calls: 7
+        errors: 0
+        hits: 2
+        rejected: 0
+        retries: 0
+        bytes: 962
+        time: 0.912
+        actions:
+            getAgents: {"calls": 2, "errors": 0, "hits": 1, "rejected": 0,
+                        "retries": 0, "bytes": 76, "time": 0.061,
+                        "p50": 0.0, "p95": 0.061}
+            getHost: {"calls": 2, "errors": 0, "hits": 1, "rejected": 0,
+                      "retries": 0, "bytes": 218, "time": 0.201,
+                      "p50": 0.0, "p95": 0.201}
+            getHostGroups: {"calls": 1, "errors": 0, "hits": 0,
+                            "rejected": 0, "retries": 0, "bytes": 380,
+                            "time": 0.24, "p50": 0.24, "p95": 0.24}
+            getHostProperties: {"calls": 1, "errors": 0, "hits": 0,
+                                "rejected": 0, "retries": 0, "bytes": 70,
+                                "time": 0.179, "p50": 0.179, "p95": 0.179}
+            updateHost: {"calls": 1, "errors": 0, "hits": 0,
+                         "rejected": 0, "retries": 0, "bytes": 218,
+                         "time": 0.231, "p50": 0.231, "p95": 0.231}
+        callers:
+            get_collectors: {"calls": 2, "time": 0.061}
+            get_host_by_displayname: {"calls": 2, "time": 0.201}
+            get_group_index: {"calls": 1, "time": 0.24}
+            get_properties: {"calls": 1, "time": 0.179}
+            update: {"calls": 1, "time": 0.231}
+connections:
+    description: >
+        number of HTTPS connections opened to the LogicMonitor account and
+        how many requests reused an already open connection
+    returned: success
+    type: dictionary
+    sample: {"opened": 1, "reused": 5}
+retries:
+    description: >
+        number of requests retried, how many of them LogicMonitor throttled
+        and the total number of seconds spent waiting for the rate limit
+        and between retries
+    returned: success
+    type: dictionary
+    sample: {"retries": 2, "throttled": 2, "wait": 1.35}
+hedged:
+    description: >
+        number of read requests sent a second time because the first was
+        slow, and how many of those replied first
+    returned: when hedge_percentile is set
+    type: dictionary
+    sample: {"hedged": 1, "won": 1}
+circuit:
+    description: >
+        state of the circuit breaker (closed, open or half-open), the number
+        of consecutive failed requests and the number of requests refused
+        while the circuit was open
+    returned: when circuit_threshold is set
+    type: dictionary
+    sample: {"state": "closed", "failures": 0, "rejected": 0}
+cache:
+    description: >
+        number of read-only API calls answered from the response cache
+        (hits) and from the LogicMonitor account (misses)
+    returned: success
+    type: dictionary
+    sample: {"hits": 7, "misses": 3}
+shared_cache:
+    description: >
+        number of account listings read from the controller's shared cache
+        (hits) and stored in it by this task (fills)
+    returned: success when cache_ttl is set
+    type: dictionary
+    sample: {"hits": 2, "fills": 1}
+delta:
+    description: >
+        the changes made by an update. Lists the names of the fields,
+        properties and groups which were added, changed or removed and
+        the opType used to apply them. Property values are never included.
+    returned: when action is update and the object exists
+    type: dictionary
+    sample: {"opType": "add", "fields": ["description"],
+             "properties": {"added": [], "changed": ["snmp.community"],
+                            "removed": []},
+             "groups": {"added": ["/servers/linux"], "removed": []}}
+operations:
+    description: >
+        the operations saved by action=plan or carried out by action=apply,
+        such as groups to create and hosts to add or update. Property values
+        are never included.
+    returned: when action is plan or apply
+    type: list
+    sample: [{"op": "createGroups", "fullpaths": ["/servers/linux"]},
+             {"op": "addHost", "key": "web1.mycompany.com",
+              "groups": ["/servers/linux"]}]
+plan_file:
+    description: the file the plan was saved to
+    returned: when action is plan
+    type: string
+    sample: "/home/user/logicmonitor.plan"
+results:
+    description: >
+        one entry per host when the hosts parameter is used, with the
+        host's hostname, displayname, whether it changed, whether it
+        failed with msg, and the delta applied by an update
+    returned: when hosts is set
+    type: list
+    sample: [{"hostname": "web1.mycompany.com", "displayname": null,
+              "changed": false, "failed": false}]
+state_cache:
+    description: >
+        number of objects found unchanged since the supplied parameters were
+        last applied (hits) and which had to be compared with the
+        LogicMonitor account (misses)
+    returned: success when state_cache is set
+    type: dictionary
+    sample: {"hits": 1, "misses": 0}
+verify_cache:
+    description: >
+        number of masked properties whose values were known to match
+        from an earlier verification (hits) and which had to be verified
+        with the LogicMonitor account (misses)
+    returned: success when verify_ttl is set
+    type: dictionary
+    sample: {"hits": 4, "misses": 0}
 ...
 '''
 
@@ -94,9 +263,17 @@ options:
             - >
                 "SDT: Schedule downtime for an object in your
                 LogicMonitor account"
+            - >
+                "Plan: Work out every change an update would make to a host,
+                hosts or a host group and save them to plan_file without
+                changing anything"
+            - >
+                "Apply: Make the changes saved in plan_file. Objects modified
+                since the plan was made are not changed, and objects the plan
+                adds which already exist as planned are skipped"
         required: true
         default: null
-        choices: ['add', 'remove', 'update', 'sdt']
+        choices: ['add', 'remove', 'update', 'sdt', 'plan', 'apply']
         version_added: "2.1"
     company:
         description:
@@ -183,6 +360,10 @@ options:
             - >
                 This parameter will add or update existing properties in your
                 LogicMonitor account or
+            - >
+                Updating a host only writes the properties which differ.
+                Properties of the host which aren't listed are kept. Host
+                group properties which aren't listed are removed.
         required: false
         default: {}
         choices: null
@@ -233,6 +414,219 @@ options:
         default: 30
         choices: null
         version_added: "2.1"
+    timeout:
+        description:
+            - >
+                The number of seconds to wait for a response to each request
+                made to the LogicMonitor API
+        required: false
+        default: 30
+        choices: null
+        version_added: "2.2"
+    rate_limit:
+        description:
+            - >
+                The maximum number of requests a second sent to the
+                LogicMonitor account by all tasks on the controller. Tasks
+                share the budget through a file in cache_dir. The rate is
+                lowered while LogicMonitor throttles requests and recovers
+                afterwards.
+            - Set to 0 to send requests as fast as possible
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    retries:
+        description:
+            - >
+                The number of times a request is retried after a short,
+                growing delay. Requests LogicMonitor throttled are always
+                retried, honouring any Retry-After header. Read-only
+                requests are also retried after connection errors, time
+                outs and server errors.
+        required: false
+        default: 3
+        choices: null
+        version_added: "2.2"
+    deadline:
+        description:
+            - >
+                The number of seconds the task may spend talking to the
+                LogicMonitor API. The timeout of each request is cut short
+                so that it ends by the deadline, and the task fails once
+                the deadline has passed instead of sending more requests.
+            - Set to 0 for no deadline
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    hedge_percentile:
+        description:
+            - >
+                When a read request takes longer than this percentile of
+                the latency of recent requests of the same kind, send it a
+                second time and use whichever reply arrives first. Recent
+                latencies are shared by every task on the controller
+                through a file in cache_dir. For example, 95 hedges about
+                one read in twenty.
+            - Set to 0 to never hedge requests
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    circuit_threshold:
+        description:
+            - >
+                The number of consecutive requests which may fail with
+                connection errors, time outs or server errors before the
+                module stops sending requests to the LogicMonitor account.
+                The circuit state is shared by every task on the controller
+                through a file in cache_dir, so that once LogicMonitor is
+                unavailable later tasks fail at once instead of waiting for
+                their requests to time out.
+            - Set to 0 to disable the circuit breaker
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    circuit_reset:
+        description:
+            - >
+                The number of seconds requests are refused once the circuit
+                breaker opens. A single request is then sent to check
+                whether LogicMonitor has recovered. The circuit closes if it
+                succeeds and stays open for another circuit_reset seconds
+                if it fails.
+        required: false
+        default: 60
+        choices: null
+        version_added: "2.2"
+    cache_ttl:
+        description:
+            - >
+                The number of seconds account-wide listings (host groups,
+                collectors and hosts) fetched by one task may be reused by
+                other tasks running on the same controller. This avoids
+                every fork downloading the same listings at once.
+            - Set to 0 to disable the shared cache
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    cache_dir:
+        description:
+            - >
+                Directory on the controller where shared cache files are
+                kept. Must be writable only by the user running Ansible.
+        required: false
+        default: "$TMPDIR/ansible-logicmonitor-$UID"
+        choices: null
+        version_added: "2.2"
+    verify_ttl:
+        description:
+            - >
+                The number of seconds a masked property (such as a
+                password) found to match the desired value is trusted
+                before it is verified with LogicMonitor again. Only a
+                salted hash of the value is kept in cache_dir. Entries
+                are dropped whenever this module updates the property.
+            - Set to 0 to verify masked properties on every run
+        required: false
+        default: 0
+        choices: null
+        version_added: "2.2"
+    state_cache:
+        description:
+            - >
+                Remember a salted hash of the parameters applied to each
+                host and host group in cache_dir, along with the object's
+                last modification marker. When an update is run again with
+                the same parameters and the object is unmodified, the full
+                comparison of properties and groups is skipped.
+            - >
+                Changes made outside of this module are only noticed when
+                they modify the object's record, not its properties alone,
+                unless LogicMonitor reports an updatedOn time.
+        required: false
+        default: false
+        choices: [true, false]
+        version_added: "2.2"
+    hosts:
+        description:
+            - >
+                A list of hosts to manage in a single task, for use with
+                target=host. Each item is a hash which may set action,
+                hostname, displayname, collector, description, groups,
+                properties, alertenable, starttime and duration. Each item
+                needs a hostname or displayname; either one defaults to the
+                other. Other parameters not set on an item are taken from
+                the task. Values are checked as for the task's own
+                parameters, so groups may also be a comma separated string.
+            - >
+                Account listings and connections are shared by every host in
+                the list. The result holds one entry per host in results and
+                changed is true if any host changed.
+        required: false
+        default: null
+        choices: null
+        version_added: "2.2"
+    parallelism:
+        description:
+            - The number of hosts in the hosts list handled at once
+        required: false
+        default: 4
+        choices: null
+        version_added: "2.2"
+    metrics_file:
+        description:
+            - >
+                Path of a node exporter textfile collector file (ending in
+                .prom) on the controller to which the task adds counters of
+                RPC calls, errors, retries, cache hits, rejected calls and
+                response bytes by action, along with histograms of RPC
+                latency and of task duration by target and action. Totals
+                over every run are kept in a .json file alongside, which
+                tasks update under a lock before rewriting the collector
+                file.
+        required: false
+        default: null
+        choices: null
+        version_added: "2.2"
+    profile_dir:
+        description:
+            - >
+                Directory on the controller in which to save a CPU profile
+                of the task, in pstats format, named after the target,
+                action and object. Work done by the threads which handle
+                hosts and groups concurrently is included. May also be
+                set with the LOGICMONITOR_PROFILE_DIR environment variable.
+        required: false
+        default: null
+        choices: null
+        version_added: "2.2"
+    profile_memory:
+        description:
+            - >
+                Also save the top memory allocation sites when profiling.
+                Allocations are only traced if the tracemalloc module (the
+                pytracemalloc backport on Python 2) is available; otherwise
+                the peak memory use and the most common types of objects
+                are saved. May also be set with the
+                LOGICMONITOR_PROFILE_MEMORY environment variable.
+        required: false
+        default: false
+        choices: [true, false]
+        version_added: "2.2"
+    plan_file:
+        description:
+            - >
+                The file written by action=plan and read by action=apply.
+                It holds the property values to be written, so it is
+                created readable only by its owner.
+        required: false
+        default: null
+        choices: null
+        version_added: "2.2"
 ...
 '''
 EXAMPLES = '''
@@ -561,11 +955,2133 @@ EXAMPLES = '''
             company='{{ company }}'
             user='{{ user }}'
             password='{{ password }}'
+
+    #example of reviewing changes before making them
+    ---
+    - hosts: hosts
+      vars:
+        company: 'mycompany'
+        user: 'myusername'
+        password: 'mypassword'
+      tasks:
+      - name: Save the changes needed to a plan
+        local_action: >
+            logicmonitor
+            target=host
+            action=plan
+            plan_file=/tmp/{{ inventory_hostname }}.plan
+            collector='mycompany-Collector'
+            company='{{ company }}'
+            user='{{ user }}'
+            password='{{ password }}'
+            groups="/servers/production"
+      - name: Make the planned changes
+        local_action: >
+            logicmonitor
+            target=host
+            action=apply
+            plan_file=/tmp/{{ inventory_hostname }}.plan
+            company='{{ company }}'
+            user='{{ user }}'
+            password='{{ password }}'
+
+    #example of managing many hosts in a single task
+    ---
+    - hosts: localhost
+      vars:
+        company: 'mycompany'
+        user: 'myusername'
+        password: 'mypassword'
+      tasks:
+      - name: Update LogicMonitor hosts
+        logicmonitor:
+            target: host
+            action: update
+            collector: mycompany-Collector
+            company: '{{ company }}'
+            user: '{{ user }}'
+            password: '{{ password }}'
+            groups: ["/servers/production"]
+            parallelism: 8
+            hosts:
+            - hostname: web1.mycompany.com
+              properties: {"type": "web"}
+            - hostname: db1.mycompany.com
+              groups: ["/servers/production/database"]
+              properties: {"type": "db"}
 '''
 
 
+# Number of host groups created concurrently
+GROUP_WORKERS = 4
+
+# Number of concurrent lookups made while initializing a host
+LOOKUP_WORKERS = 2
+
+# Statuses with which LogicMonitor rejects requests sent too quickly
+THROTTLE_STATUS = frozenset([429, 503])
+
+# Seconds to wait before the first retry of a failed request; each
+# further retry waits up to twice as long, at most RETRY_MAX seconds
+RETRY_BASE = 0.5
+RETRY_MAX = 30
+
+# Number of recent latencies kept for each read action, and how
+# many must be known before slow reads are hedged
+LATENCY_WINDOW = 50
+HEDGE_MIN_SAMPLES = 10
+
+# Number of latencies a task records before sharing them
+# with the others; any left over are shared when it exits
+LATENCY_FLUSH = 10
+
+# Upper bounds in seconds of the latency histogram buckets
+# exported for RPC calls and for whole tasks
+RPC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TASK_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Number of allocation sites (or object types) in a memory profile
+PROFILE_TOP = 25
+
+# Version of the plan file format written by the plan action
+PLAN_VERSION = 1
+
+# Parameters which may be given for each host in a batch
+BATCH_PARAMS = frozenset([
+    "action",
+    "alertenable",
+    "collector",
+    "description",
+    "displayname",
+    "duration",
+    "groups",
+    "hostname",
+    "properties",
+    "starttime"])
+
+# Read-only RPC actions whose responses may be served from cache
+READ_ACTIONS = frozenset([
+    "getAgents",
+    "getHost",
+    "getHostGroup",
+    "getHostGroupProperties",
+    "getHostGroups",
+    "getHostProperties",
+    "getHosts",
+    "getTimeZoneSetting"])
+
+# Read-only RPC actions which must always go to the server
+UNCACHED_ACTIONS = frozenset([
+    "verifyProperties"])
+
+# Account-wide listings which may be shared between processes
+SHARED_ACTIONS = frozenset([
+    "getAgents",
+    "getHostGroups",
+    "getHosts"])
+
+# Cached read actions made stale by each mutating RPC action.
+# Mutations not listed here invalidate the whole cache. Changes to
+# hosts leave the host group listings, which don't describe them,
+# untouched.
+_HOST_READS = ["getHost", "getHosts", "getHostProperties"]
+_GROUP_READS = ["getHost", "getHosts", "getHostProperties",
+                "getHostGroup", "getHostGroups", "getHostGroupProperties"]
+INVALIDATES = {
+    "addAgent": ["getAgents"],
+    "deleteAgent": ["getAgents", "getHost", "getHosts"],
+    "setAgentSDT": ["getAgents"],
+    "addHost": _HOST_READS,
+    "updateHost": _HOST_READS,
+    "deleteHost": _HOST_READS,
+    "setHostSDT": ["getHost", "getHosts"],
+    "addHostGroup": _GROUP_READS,
+    "updateHostGroup": _GROUP_READS,
+    "deleteHostGroup": _GROUP_READS,
+    "setHostGroupSDT": ["getHostGroup", "getHostGroups"]}
+
+# Mutating RPC actions which change a single host, with the parameter
+# holding its id. Only that host's entries in the response cache are
+# dropped, and the index of the getHosts listing is updated in place.
+HOST_MUTATIONS = {
+    "addHost": None,
+    "updateHost": "id",
+    "deleteHost": "hostId",
+    "setHostSDT": "hostId"}
+
+# Mutating RPC actions which overwrite the properties of an existing
+# object, with the kind of object and the parameter holding its id
+WRITES_PROPERTIES = {
+    "updateHost": ("hostId", "id"),
+    "deleteHost": ("hostId", "hostId"),
+    "updateHostGroup": ("hostGroupId", "id"),
+    "deleteHostGroup": ("hostGroupId", "hgId")}
+
+
+def percentile(samples, percent):
+    """Returns the value below which percent of the sorted
+    samples fall, or None if there are no samples"""
+    if not samples:
+        return None
+
+    return samples[min(len(samples) - 1,
+                       int(len(samples) * percent / 100.0))]
+
+
+def private_dir(directory):
+    """Create directory, readable only by the current user,
+    if it does not already exist"""
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+
+def account_prefix(*names):
+    """Returns the short digest which prefixes the files kept
+    on the controller for the account identified by names"""
+    return hashlib.sha1("\0".join(names)).hexdigest()[:16]
+
+
+def account_path(directory, suffix, *names):
+    """Create directory if needed and return the path of the
+    file suffix in it for the account identified by names"""
+    private_dir(directory)
+    return os.path.join(directory, "{0}-{1}".format(
+        account_prefix(*names), suffix))
+
+
+class JSONStore(object):
+
+    def __init__(self, path):
+        """Initializor for a JSON document on disk shared by every
+        process on the controller. Readers and writers are serialized
+        with a lock file and the document is replaced atomically"""
+        self.path = path
+        self.lockpath = path + ".lock"
+
+    def read(self):
+        """Return the stored document, or an empty
+        hash if it doesn't exist or can't be read"""
+        lock = open(self.lockpath, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            return self._load()
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def update(self, func):
+        """Call func with the stored document while holding the
+        lock, then write the document back. Returns the result
+        of func"""
+        lock = open(self.lockpath, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._load()
+            result = func(data)
+            self._write(data)
+            return result
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def write(self, data):
+        """Replace the stored document with data.
+        Returns true if it was written"""
+        lock = open(self.lockpath, "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self._write(data)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+        if not isinstance(data, dict):
+            return {}
+
+        return data
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+            return True
+        except (IOError, OSError), e:
+            logging.debug("Unable to write {0}. {1}".format(self.path, e))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return False
+
+
+class VerifyCache(object):
+
+    def __init__(self, directory, company, user, ttl):
+        """Initializor for a cache of positive verifyProperties
+        results. Entries are keyed by object and property name and
+        hold a salted HMAC of the verified value, so that secrets are
+        never written to disk"""
+        logging.debug("Instantiating VerifyCache in {0}".format(directory))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.store = JSONStore(account_path(
+            directory, "verified.json", company, user))
+        self.salt = None
+
+    def lookup(self, target, properties):
+        """Return the names of the properties in the hash
+        properties already verified to match on target"""
+        data = self.store.read()
+        entries = data.get("entries", {})
+        salt = data.get("salt")
+        now = time.time()
+        matched = set()
+
+        if salt is not None:
+            self.salt = salt
+
+            for name, value in properties.items():
+                entry = entries.get(self._key(target, name))
+                if (entry is not None and entry["expires"] > now and
+                   entry["hmac"] == self._hmac(target, name, value)):
+                    matched.add(name)
+
+        self.hits = self.hits + len(matched)
+        self.misses = self.misses + len(properties) - len(matched)
+        return matched
+
+    def remember(self, target, properties):
+        """Record that the values in the hash
+        properties were verified to match on target"""
+        if not properties:
+            return
+
+        def remember(data):
+            if "salt" not in data:
+                data["salt"] = os.urandom(16).encode("hex")
+            self.salt = data["salt"]
+
+            now = time.time()
+            entries = dict((key, entry) for key, entry
+                           in data.get("entries", {}).items()
+                           if entry["expires"] > now)
+
+            for name, value in properties.items():
+                entries[self._key(target, name)] = {
+                    "hmac": self._hmac(target, name, value),
+                    "expires": now + self.ttl}
+
+            data["entries"] = entries
+
+        self.store.update(remember)
+
+    def forget(self, target, names=None):
+        """Drop the entries for the named properties of target, or
+        all of its entries if names is None. A target id of None
+        matches every object of that kind"""
+        logging.debug("Forgetting verified properties of {0}"
+                      .format(self._key(target, "")))
+        kind, oid = target.items()[0]
+
+        def forget(data):
+            entries = data.get("entries", {})
+            for key in entries.keys():
+                parts = key.split(":", 2)
+                if (parts[0] == kind and
+                   (oid is None or parts[1] == str(oid)) and
+                   (names is None or parts[2] in names)):
+                    del entries[key]
+
+        self.store.update(forget)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _key(target, name):
+        kind, oid = target.items()[0]
+        return "{0}:{1}:{2}".format(kind, oid, name)
+
+    def _hmac(self, target, name, value):
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+
+        return hmac.new(
+            str(self.salt),
+            "\0".join([self._key(target, name), str(value)]),
+            hashlib.sha256).hexdigest()
+
+
+class StateStore(object):
+
+    def __init__(self, directory, company, user):
+        """Initializor for a record of the desired state last applied
+        to each object and the marker of the remote object it left
+        behind. Desired states are stored as salted HMACs"""
+        logging.debug("Instantiating StateStore in {0}".format(directory))
+        self.hits = 0
+        self.misses = 0
+        self.store = JSONStore(account_path(
+            directory, "state.json", company, user))
+
+    def is_current(self, key, desired, marker):
+        """Return true if desired was the last state applied to
+        the object key and the object still carries marker"""
+        data = self.store.read()
+        entry = data.get("entries", {}).get(key)
+        salt = data.get("salt")
+
+        if (entry is not None and salt is not None and
+           entry["marker"] == marker and
+           entry["fingerprint"] == self._fingerprint(salt, key, desired)):
+            self.hits = self.hits + 1
+            return True
+
+        self.misses = self.misses + 1
+        return False
+
+    def record(self, key, desired, marker):
+        """Record that desired was applied to the
+        object key, leaving it with marker"""
+        def record(data):
+            if "salt" not in data:
+                data["salt"] = os.urandom(16).encode("hex")
+
+            data.setdefault("entries", {})[key] = {
+                "fingerprint": self._fingerprint(data["salt"], key, desired),
+                "marker": marker}
+
+        self.store.update(record)
+
+    def forget(self, key):
+        def forget(data):
+            data.get("entries", {}).pop(key, None)
+
+        self.store.update(forget)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    @staticmethod
+    def _fingerprint(salt, key, desired):
+        return hmac.new(
+            str(salt),
+            "\0".join([key, json.dumps(desired, sort_keys=True,
+                                       default=str)]),
+            hashlib.sha256).hexdigest()
+
+
+class SharedCache(object):
+
+    def __init__(self, directory, company, user, ttl):
+        """Initializor for a cache of account listings shared by
+        every process on the controller. Entries are files holding
+        an expiry time followed by the raw response; concurrent
+        fills of the same entry are serialized with a lock file"""
+        logging.debug("Instantiating SharedCache in {0}".format(directory))
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.fills = 0
+        self.prefix = account_prefix(company, user)
+        private_dir(directory)
+
+    def fetch(self, action, params, call):
+        """Return the RPCResponse for action from the shared cache,
+        using call(action, params) to fill the entry if it is missing
+        or expired. Only one process fills an entry at a time; the
+        others wait for it and then read the stored response"""
+        f, resp = self._get(action, params, call)
+
+        if f is None:
+            return resp
+
+        # mmap.read() requires a size in Python 2
+        try:
+            return RPCResponse(f[f.tell():])
+        finally:
+            f.close()
+
+    def open(self, action, params, call):
+        """Like fetch, but returns a file-like object over the
+        stored response instead of decoding it"""
+        f, resp = self._get(action, params, call)
+
+        if f is None and resp is not None:
+            return StringIO(resp.raw)
+
+        return f
+
+    def _get(self, action, params, call):
+        """Returns (f, None) with f mapping a fresh entry, or
+        (None, resp) with the response of a call made to fill it"""
+        path = self._path(action, params)
+
+        f = self._open(path)
+        if f is not None:
+            self.hits = self.hits + 1
+            return f, None
+
+        lock = open(path + ".lock", "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            f = self._open(path)
+            if f is not None:
+                self.hits = self.hits + 1
+                return f, None
+
+            resp = call(action, params)
+
+            if resp is not None and resp.status == 200:
+                logging.debug("Filling shared cache entry {0}".format(path))
+                self.fills = self.fills + 1
+                self._write(path, resp.raw)
+
+            return None, resp
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def invalidate(self, mutation):
+        """Remove this account's entries made stale by the
+        mutating action"""
+        actions = INVALIDATES.get(mutation)
+
+        for name in os.listdir(self.directory):
+            parts = name.split("-")
+            if (len(parts) == 3 and parts[0] == self.prefix and
+               name.endswith(".cache") and
+               (actions is None or parts[1] in actions)):
+
+                logging.debug("Removing shared cache entry {0}".format(name))
+                try:
+                    os.unlink(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def stats(self):
+        return {"hits": self.hits, "fills": self.fills}
+
+    def _path(self, action, params):
+        digest = hashlib.sha1(ResponseCache._key(params)).hexdigest()[:16]
+        return os.path.join(
+            self.directory,
+            "{0}-{1}-{2}.cache".format(self.prefix, action, digest))
+
+    def _open(self, path):
+        """Map the entry into memory and return the map positioned
+        at the start of the response, or None if the entry doesn't
+        exist or has expired"""
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        end = mm.find("\n")
+        if end < 0 or float(mm[:end]) < time.time():
+            mm.close()
+            return None
+
+        mm.seek(end + 1)
+        return mm
+
+    def _write(self, path, raw):
+        """Atomically replace the entry so that readers
+        never see a partial response"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write("{0}\n".format(time.time() + self.ttl))
+                f.write(raw)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            logging.debug("Unable to write shared cache entry. {0}"
+                          .format(e))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+class RPCResponse(object):
+
+    def __init__(self, raw):
+        """Initializor for a decoded RPC response. The body is
+        decoded once; raw is only kept until the caller drops it"""
+        resp = json_loads(raw)
+
+        self.raw = raw
+        self.size = len(raw)
+        self.status = resp.get("status")
+        self.errmsg = resp.get("errmsg")
+        self.data = resp.get("data")
+
+    def __repr__(self):
+        return "<RPCResponse status={0} errmsg={1!r} bytes={2}>".format(
+            self.status, self.errmsg, self.size)
+
+
+class PooledResponse(object):
+
+    def __init__(self, pool, conn, response):
+        """Wrapper around an HTTP response which returns the underlying
+        connection to its pool once the body has been consumed"""
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.released = False
+
+    def read(self, amt=None):
+        """Read from the response body. The connection is
+        released as soon as the body is exhausted"""
+        try:
+            data = self.response.read(amt)
+        except (httplib.HTTPException, socket.error), e:
+            self.close()
+            raise IOError(e)
+
+        if amt is None or not data:
+            self.close()
+
+        return data
+
+    def close(self):
+        """Release the connection back to the pool. Connections are
+        only kept if the whole body was read and the server allows it"""
+        if self.released:
+            return
+
+        self.released = True
+        reusable = (self.response.isclosed() and
+                    not self.response.will_close)
+        self.pool.release(self.conn, reusable)
+
+
+class ConnectionPool(object):
+
+    def __init__(self, host, size=4, idle=60):
+        """Initializor for a pool of persistent HTTPS
+        connections to a single host"""
+        logging.debug("Instantiating ConnectionPool for {0}".format(host))
+        self.host = host
+        self.size = size
+        self.idle = idle
+        self.proxy = self._find_proxy(host)
+        self.opened = 0
+        self.reused = 0
+        self._free = []
+        self._busy = 0
+        self._cond = threading.Condition()
+
+    def urlopen(self, path, headers, timeout):
+        """Issue a GET request for path and return a PooledResponse.
+        A request on a reused connection which the server has since
+        closed is retried once on a fresh connection"""
+        conn, reused = self._acquire(timeout)
+
+        try:
+            conn.request("GET", path, headers=headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            self.release(conn, False)
+
+            # A time out doesn't mean the server closed the connection
+            if not reused or isinstance(e, socket.timeout):
+                raise IOError(e)
+
+            logging.debug("Reused connection failed. Reconnecting.")
+            conn, reused = self._acquire(timeout, fresh=True)
+
+            try:
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error), e:
+                self.release(conn, False)
+                raise IOError(e)
+
+        resp = PooledResponse(self, conn, response)
+
+        if response.status >= 400:
+            resp.read()
+            raise urllib2.HTTPError(
+                "https://{0}{1}".format(self.host, path.split("?", 1)[0]),
+                response.status, response.reason, response.msg, None)
+
+        return resp
+
+    def release(self, conn, reusable=True):
+        """Return a connection checked out by _acquire"""
+        with self._cond:
+            self._busy = self._busy - 1
+
+            if reusable:
+                self._free.append((conn, time.time()))
+            else:
+                conn.close()
+
+            self._cond.notify()
+
+    def close(self):
+        """Close all idle connections"""
+        with self._cond:
+            for conn, last_used in self._free:
+                conn.close()
+            self._free = []
+
+    def stats(self):
+        return {"opened": self.opened, "reused": self.reused}
+
+    def _acquire(self, timeout, fresh=False):
+        """Check out an idle connection, or open a new one if the
+        pool isn't full. Blocks while all connections are in use"""
+        with self._cond:
+            while True:
+                self._evict()
+
+                if self._free and not fresh:
+                    conn, last_used = self._free.pop()
+                    self._busy = self._busy + 1
+                    self.reused = self.reused + 1
+
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+
+                    return conn, True
+
+                if self._busy + len(self._free) < self.size:
+                    break
+
+                if self._free:
+                    # Make room for a fresh connection
+                    conn, last_used = self._free.pop(0)
+                    conn.close()
+                    break
+
+                self._cond.wait()
+
+            self._busy = self._busy + 1
+            self.opened = self.opened + 1
+
+        if self.proxy is None:
+            logging.debug("Opening new connection to {0}".format(self.host))
+            return httplib.HTTPSConnection(self.host, timeout=timeout), False
+
+        proxy, headers = self.proxy
+        logging.debug("Opening new connection to {0} through {1}"
+                      .format(self.host, proxy))
+        conn = httplib.HTTPSConnection(proxy, timeout=timeout)
+        conn.set_tunnel(self.host, headers=headers)
+        return conn, False
+
+    @staticmethod
+    def _find_proxy(host):
+        """Returns the address of the HTTPS proxy set in the environment
+        (https_proxy, no_proxy) for host and the headers to send it, or
+        None if host should be reached directly"""
+        proxy = urllib.getproxies().get("https")
+        if not proxy or urllib.proxy_bypass(host):
+            return None
+
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        parts = urlparse.urlparse(proxy)
+
+        headers = {}
+        if parts.username:
+            headers["Proxy-Authorization"] = "Basic " + base64.b64encode(
+                "{0}:{1}".format(urllib.unquote(parts.username),
+                                 urllib.unquote(parts.password or "")))
+
+        return "{0}:{1}".format(parts.hostname, parts.port or 80), headers
+
+    def _evict(self):
+        """Close connections which have been idle too long.
+        Must be called with the pool lock held"""
+        now = time.time()
+        free = []
+
+        for conn, last_used in self._free:
+            if now - last_used > self.idle:
+                logging.debug("Closing idle connection to {0}"
+                              .format(self.host))
+                conn.close()
+            else:
+                free.append((conn, last_used))
+
+        self._free = free
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate):
+        """Initializor for a token bucket allowing rate requests a
+        second, in bursts of up to one second's worth. A rate of 0
+        disables limiting. The rate is halved whenever the server
+        throttles a request and recovers as requests succeed"""
+        self.limit = float(rate)
+        self.rate = float(rate)
+        self.burst = max(1.0, self.limit)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.retries = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until another request may be sent"""
+        if self.limit <= 0:
+            return
+
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Take the token now so that later callers queue behind us
+            self.tokens = self.tokens - 1
+            wait = max(0.0, -self.tokens / self.rate)
+
+        if wait > 0:
+            self._sleep(wait)
+
+    def succeeded(self):
+        """Raise the rate back towards the limit
+        after a request was accepted"""
+        if self.rate < self.limit:
+            self._speed_up()
+
+    def backoff(self, attempt, delay, throttled, limit=None):
+        """Wait before retry number attempt of a request. delay is
+        the number of seconds the server asked us to wait, if any,
+        and limit the most we may wait"""
+        with self._lock:
+            self.retries = self.retries + 1
+
+            if throttled:
+                self.throttled = self.throttled + 1
+
+        if throttled and self.limit > 0:
+            self._slow_down()
+
+        # Jitter keeps concurrent clients from retrying in lockstep
+        wait = random.uniform(0, min(RETRY_MAX, RETRY_BASE * 2 ** attempt))
+        if delay is not None:
+            wait = max(wait, min(RETRY_MAX, delay))
+        if limit is not None:
+            wait = max(0.0, min(wait, limit))
+
+        logging.debug("Retrying in {0:.2f} seconds".format(wait))
+        self._sleep(wait)
+
+    def stats(self):
+        return {"retries": self.retries,
+                "throttled": self.throttled,
+                "wait": round(self.waited, 3)}
+
+    def _speed_up(self):
+        with self._lock:
+            self.rate = min(self.limit, self.rate + self.limit / 20)
+
+    def _slow_down(self):
+        with self._lock:
+            self.rate = max(self.limit / 16, self.rate / 2)
+
+    def _sleep(self, seconds):
+        with self._lock:
+            self.waited = self.waited + seconds
+
+        time.sleep(seconds)
+
+
+class SharedRateLimiter(RateLimiter):
+
+    def __init__(self, rate, directory, company):
+        """Initializor for a RateLimiter whose bucket is kept in a file
+        in directory, so that every process on the controller draws
+        on a single budget for the account"""
+        RateLimiter.__init__(self, rate)
+        logging.debug("Instantiating SharedRateLimiter in {0}"
+                      .format(directory))
+
+        self.store = JSONStore(account_path(
+            directory, "ratelimit.json", company))
+
+    def acquire(self):
+        """Wait until another request may be sent by any process"""
+        if self.limit <= 0:
+            return
+
+        def take(data):
+            now = time.time()
+            rate = min(self.limit, data.get("rate", self.limit))
+            tokens = min(self.burst,
+                         data.get("tokens", self.burst) +
+                         max(0.0, now - data.get("updated", now)) * rate)
+
+            # Take the token now so that later callers queue behind us
+            data["tokens"] = tokens - 1
+            data["updated"] = now
+            data["rate"] = rate
+            return rate, max(0.0, (1 - tokens) / rate)
+
+        try:
+            self.rate, wait = self.store.update(take)
+        except (IOError, OSError), e:
+            logging.debug("Unable to use the shared rate limit. {0}"
+                          .format(e))
+            return RateLimiter.acquire(self)
+
+        if wait > 0:
+            self._sleep(wait)
+
+    def _speed_up(self):
+        def speed_up(data):
+            data["rate"] = min(self.limit,
+                               data.get("rate", self.limit) +
+                               self.limit / 20)
+
+        try:
+            self.store.update(speed_up)
+        except (IOError, OSError):
+            RateLimiter._speed_up(self)
+
+    def _slow_down(self):
+        def slow_down(data):
+            data["rate"] = max(self.limit / 16,
+                               data.get("rate", self.limit) / 2)
+
+        try:
+            self.store.update(slow_down)
+        except (IOError, OSError):
+            RateLimiter._slow_down(self)
+
+
+class CircuitOpenError(IOError):
+    """Raised in place of sending a request while the
+    circuit breaker for an account is open"""
+    pass
+
+
+class DeadlineError(IOError):
+    """Raised in place of sending a request
+    once the task's deadline has passed"""
+    pass
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold, reset, directory, company):
+        """Initializor for a circuit breaker which stops requests to an
+        account after threshold consecutive failures. Its state is kept
+        in a file in directory so that every process on the controller
+        sees the circuit open. Once it has been open for reset seconds
+        a single request is let through to probe the account"""
+        logging.debug("Instantiating CircuitBreaker in {0}"
+                      .format(directory))
+        self.threshold = threshold
+        self.reset = reset
+        self.rejected = 0
+        self.state = {}
+        self._healthy = True
+        self._lock = threading.Lock()
+
+        self.store = JSONStore(account_path(
+            directory, "circuit.json", company))
+
+    def allow(self):
+        """Returns true if a request may be sent to the account"""
+        data = self._read()
+        self._healthy = not data.get("failures")
+        if data.get("opened") is None:
+            return True
+
+        def probe(data):
+            opened = data.get("opened")
+            if opened is None:
+                return True
+
+            now = time.time()
+            if (now - opened < self.reset or
+               now - data.get("probing", 0) < self.reset):
+                return False
+
+            # Half open: this request probes the account for
+            # everyone, until it finishes or reset seconds pass
+            data["probing"] = now
+            return True
+
+        if self._update(probe):
+            logging.debug("Probing the account with the circuit half open")
+            return True
+
+        with self._lock:
+            self.rejected = self.rejected + 1
+        return False
+
+    def success(self):
+        """Close the circuit after a request reached the account"""
+        if self._healthy:
+            return
+
+        def close(data):
+            if data.get("opened") is not None:
+                logging.debug("Closing the circuit")
+            data.clear()
+
+        self._update(close)
+        self._healthy = True
+
+    def failure(self):
+        """Count a request which failed to reach the account, opening
+        the circuit once threshold requests in a row have failed or
+        when the probe of a half open circuit fails"""
+        def fail(data):
+            data["failures"] = data.get("failures", 0) + 1
+            if (data.get("opened") is not None or
+               data["failures"] >= self.threshold):
+                data["opened"] = time.time()
+                data.pop("probing", None)
+                return data["failures"]
+
+        self._healthy = False
+        failures = self._update(fail)
+        if failures:
+            logging.debug("Circuit open after {0} failures"
+                          .format(failures))
+
+    def error(self):
+        """Returns the message reported for requests
+        rejected while the circuit is open"""
+        data = self._read()
+        wait = self.reset - (time.time() - data.get("opened", time.time()))
+        return ("Error: LogicMonitor is not responding. Not sending "
+                "requests for {0} seconds after {1} consecutive "
+                "failures".format(int(max(0, wait)) + 1,
+                                  data.get("failures", 0)))
+
+    def stats(self):
+        data = self._read()
+        if data.get("opened") is None:
+            state = "closed"
+        elif time.time() - data["opened"] < self.reset:
+            state = "open"
+        else:
+            state = "half-open"
+
+        return {"state": state,
+                "failures": data.get("failures", 0),
+                "rejected": self.rejected}
+
+    def _read(self):
+        try:
+            return self.store.read()
+        except (IOError, OSError):
+            with self._lock:
+                return dict(self.state)
+
+    def _update(self, func):
+        # Fall back to the state of this process
+        # if the file can't be used
+        try:
+            return self.store.update(func)
+        except (IOError, OSError), e:
+            logging.debug("Unable to share the circuit state. {0}"
+                          .format(e))
+            with self._lock:
+                return func(self.state)
+
+
+class LatencyTracker(object):
+
+    def __init__(self, directory, company):
+        """Initializor for a record of the latency of recent read
+        requests to an account. It is kept in a file in directory
+        so that every task on the controller learns from the others.
+        New latencies are buffered and written every LATENCY_FLUSH
+        samples and at exit"""
+        logging.debug("Instantiating LatencyTracker in {0}"
+                      .format(directory))
+        self.hedged = 0
+        self.won = 0
+        self.samples = {}
+        self.pending = {}
+        self.unflushed = 0
+        self._lock = threading.Lock()
+
+        self.store = JSONStore(account_path(
+            directory, "latency.json", company))
+
+        try:
+            self.samples = self.store.read()
+        except (IOError, OSError), e:
+            logging.debug("Unable to read recent latencies. {0}".format(e))
+
+        atexit.register(self.flush)
+
+    def percentile(self, action, percent):
+        """Returns the latency in seconds below which percent of recent
+        action requests completed, or None if too few are known"""
+        with self._lock:
+            samples = sorted(self.samples.get(action) or [])
+
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+
+        return percentile(samples, percent)
+
+    def record(self, action, seconds):
+        """Remember the latency of an action request, sharing the
+        buffered latencies once LATENCY_FLUSH have been recorded"""
+        seconds = round(seconds, 4)
+
+        with self._lock:
+            samples = list(self.samples.get(action) or [])
+            samples.append(seconds)
+            self.samples[action] = samples[-LATENCY_WINDOW:]
+            self.pending.setdefault(action, []).append(seconds)
+            self.unflushed = self.unflushed + 1
+            if self.unflushed < LATENCY_FLUSH:
+                return
+
+        self.flush()
+
+    def flush(self):
+        """Add the buffered latencies to the shared record
+        and learn those recorded by other tasks"""
+        with self._lock:
+            pending = self.pending
+            self.pending = {}
+            self.unflushed = 0
+
+        if not pending:
+            return
+
+        def add(data):
+            for action, samples in pending.items():
+                data[action] = (list(data.get(action) or []) +
+                                samples)[-LATENCY_WINDOW:]
+            return dict(data)
+
+        try:
+            recent = self.store.update(add)
+        except (IOError, OSError), e:
+            logging.debug("Unable to share recent latencies. {0}"
+                          .format(e))
+            return
+
+        # Keep the latencies recorded while the record was written
+        with self._lock:
+            for action, samples in self.pending.items():
+                recent[action] = (list(recent.get(action) or []) +
+                                  samples)[-LATENCY_WINDOW:]
+            self.samples = recent
+
+    def hedge(self, won):
+        """Count a hedged request, and whether it replied first"""
+        with self._lock:
+            self.hedged = self.hedged + 1
+            if won:
+                self.won = self.won + 1
+
+    def stats(self):
+        return {"hedged": self.hedged, "won": self.won}
+
+
+class RPCStats(object):
+
+    def __init__(self):
+        """Initializor for a record of the RPC calls made to an
+        account: how long they took, the size of their responses,
+        how often they were retried and whether a cache answered
+        them, by action and by the method which made them"""
+        self.actions = {}
+        self.callers = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Begin a call made by the current thread.
+        Returns the time it started"""
+        self._local.requests = 0
+        return time.time()
+
+    def sent(self):
+        """Count a request sent to the server for the current call"""
+        self._local.requests = getattr(self._local, "requests", 0) + 1
+
+    def requests(self):
+        """Returns the number of requests sent for the current call"""
+        return getattr(self._local, "requests", 0)
+
+    @staticmethod
+    def caller(frame):
+        """Returns the name of the first public method on the stack
+        from frame, skipping private helpers, lambdas and generator
+        expressions, or the name of frame's function if there isn't
+        one"""
+        name = frame.f_code.co_name
+
+        while frame is not None:
+            current = frame.f_code.co_name
+            if current.startswith("__") or current[0] not in "_<":
+                return current
+            frame = frame.f_back
+
+        return name
+
+    def record(self, action, caller, started, size, ok, requests):
+        """Record a finished call. A successful call which sent
+        no requests was answered from a cache, a failed one was
+        rejected before it was sent"""
+        seconds = time.time() - started
+
+        with self._lock:
+            stats = self.actions.get(action)
+            if stats is None:
+                stats = self.actions[action] = {
+                    "calls": 0, "errors": 0, "hits": 0, "rejected": 0,
+                    "retries": 0, "bytes": 0, "times": []}
+
+            stats["calls"] = stats["calls"] + 1
+            stats["times"].append(seconds)
+            if not ok:
+                stats["errors"] = stats["errors"] + 1
+            if requests == 0:
+                if ok:
+                    stats["hits"] = stats["hits"] + 1
+                else:
+                    stats["rejected"] = stats["rejected"] + 1
+            else:
+                stats["retries"] = stats["retries"] + requests - 1
+                stats["bytes"] = stats["bytes"] + size
+
+            calls = self.callers.get(caller)
+            if calls is None:
+                calls = self.callers[caller] = {"calls": 0, "time": 0.0}
+
+            calls["calls"] = calls["calls"] + 1
+            calls["time"] = calls["time"] + seconds
+
+    def stats(self):
+        totals = {"calls": 0, "errors": 0, "hits": 0, "rejected": 0,
+                  "retries": 0, "bytes": 0, "time": 0.0}
+        actions = {}
+
+        with self._lock:
+            for action, stats in self.actions.items():
+                times = sorted(stats["times"])
+                summary = dict((key, value) for key, value in stats.items()
+                               if key != "times")
+                summary["time"] = sum(times)
+
+                for key in totals:
+                    totals[key] = totals[key] + summary[key]
+
+                summary["time"] = round(summary["time"], 3)
+                summary["p50"] = round(percentile(times, 50), 3)
+                summary["p95"] = round(percentile(times, 95), 3)
+                actions[action] = summary
+
+            callers = dict((caller, {"calls": calls["calls"],
+                                     "time": round(calls["time"], 3)})
+                           for caller, calls in self.callers.items())
+
+        totals["time"] = round(totals["time"], 3)
+        totals["actions"] = actions
+        totals["callers"] = callers
+        return totals
+
+
+class MetricsExporter(object):
+
+    def __init__(self, path):
+        """Initializor for a Prometheus textfile collector file at path.
+        Counters and histograms accumulated over every run are kept in
+        a JSON file next to it, which is updated under a lock before
+        the text file is rewritten"""
+        logging.debug("Instantiating MetricsExporter for {0}".format(path))
+        self.path = path
+        self.store = JSONStore(path + ".json")
+
+    def export(self, stats, target, action, ok, seconds):
+        """Add the RPC statistics and the duration of a
+        task to the totals and rewrite the text file"""
+        def add(data):
+            counters = data.setdefault("counters", {})
+            histograms = data.setdefault("histograms", {})
+
+            for name, times in stats.actions.items():
+                labels = 'action="{0}"'.format(name)
+                for key in ["calls", "errors", "hits", "rejected",
+                            "retries", "bytes"]:
+                    self._count(counters, "rpc_{0}_total".format(key),
+                                labels, times[key])
+
+                for value in times["times"]:
+                    self._observe(histograms, "rpc_duration_seconds",
+                                  labels, value, RPC_BUCKETS)
+
+            labels = 'target="{0}",action="{1}"'.format(target, action)
+            self._count(counters, "tasks_total",
+                        '{0},result="{1}"'.format(
+                            labels, "ok" if ok else "failed"), 1)
+            self._observe(histograms, "task_duration_seconds",
+                          labels, seconds, TASK_BUCKETS)
+
+            self._rewrite(self._render(data))
+
+        self.store.update(add)
+
+    @staticmethod
+    def _count(counters, name, labels, value):
+        series = counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    @staticmethod
+    def _observe(histograms, name, labels, value, buckets):
+        series = histograms.setdefault(name, {})
+        hist = series.get(labels)
+        if hist is None:
+            hist = series[labels] = {"buckets": [0] * len(buckets),
+                                     "sum": 0.0,
+                                     "count": 0}
+
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                hist["buckets"][i] = hist["buckets"][i] + 1
+        hist["sum"] = hist["sum"] + value
+        hist["count"] = hist["count"] + 1
+
+    @staticmethod
+    def _render(data):
+        """Returns the totals in the Prometheus text format"""
+        lines = []
+        counters = data.get("counters", {})
+        histograms = data.get("histograms", {})
+
+        for name in sorted(counters):
+            metric = "logicmonitor_" + name
+            lines.append("# TYPE {0} counter".format(metric))
+            for labels, value in sorted(counters[name].items()):
+                lines.append("{0}{{{1}}} {2}".format(metric, labels, value))
+
+        # Ratio of calls answered from a cache over every run
+        calls = sum(counters.get("rpc_calls_total", {}).values())
+        if calls:
+            hits = sum(counters.get("rpc_hits_total", {}).values())
+            lines.append("# TYPE logicmonitor_rpc_cache_hit_ratio gauge")
+            lines.append("logicmonitor_rpc_cache_hit_ratio {0:.4f}"
+                         .format(float(hits) / calls))
+
+        for name in sorted(histograms):
+            metric = "logicmonitor_" + name
+            buckets = (TASK_BUCKETS if name.startswith("task")
+                       else RPC_BUCKETS)
+            lines.append("# TYPE {0} histogram".format(metric))
+
+            for labels, hist in sorted(histograms[name].items()):
+                for bound, count in zip(buckets, hist["buckets"]):
+                    lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                        metric, labels, bound, count))
+                lines.append('{0}_bucket{{{1},le="+Inf"}} {2}'.format(
+                    metric, labels, hist["count"]))
+                lines.append("{0}_sum{{{1}}} {2}".format(
+                    metric, labels, round(hist["sum"], 6)))
+                lines.append("{0}_count{{{1}}} {2}".format(
+                    metric, labels, hist["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def _rewrite(self, text):
+        """Atomically replace the text file so that the
+        collector never reads a partial file"""
+        directory = os.path.dirname(self.path) or "."
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(text)
+            os.chmod(tmp, 0644)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            logging.debug("Unable to write {0}. {1}".format(self.path, e))
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+
+class Profiler(object):
+
+    # The profiler of the module run, if one was started. Worker
+    # threads profile the tasks they run into it
+    active = None
+
+    def __init__(self, directory, name, memory=False):
+        """Initializor for a CPU profile of the module run, and
+        optionally of its memory allocations, which are saved in
+        directory in files named after name"""
+        logging.debug("Instantiating Profiler for {0}".format(name))
+        self.directory = directory
+        self.name = name
+        self.memory = memory
+        self.profile = cProfile.Profile()
+        self.workers = []
+        self.tracemalloc = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.memory:
+            # Python 2 needs the pytracemalloc backport
+            try:
+                import tracemalloc
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                logging.debug("tracemalloc isn't available. Only counting "
+                              "objects by type.")
+
+        Profiler.active = self
+        self.profile.enable()
+
+    def run(self, fn, *args, **kwargs):
+        """Return fn(*args, **kwargs), profiling it in the current
+        thread. Its profile is merged into the results by stop"""
+        profile = cProfile.Profile()
+        with self._lock:
+            self.workers.append(profile)
+
+        return profile.runcall(fn, *args, **kwargs)
+
+    def stop(self):
+        """Stop profiling and write the results. Returns the paths
+        of the pstats file and of the memory report, if any"""
+        self.profile.disable()
+        Profiler.active = None
+
+        stats = pstats.Stats(self.profile)
+        with self._lock:
+            for profile in self.workers:
+                stats.add(profile)
+
+        private_dir(self.directory)
+        base = os.path.join(self.directory, self.name)
+        paths = [base + ".pstats"]
+        stats.dump_stats(paths[0])
+
+        if self.memory:
+            paths.append(base + ".memory.txt")
+            with open(paths[1], "w") as f:
+                f.write(self._memory_report())
+
+        logging.debug("Profile written to {0}".format(", ".join(paths)))
+        return paths
+
+    def _memory_report(self):
+        """Returns the top allocation sites, or the most
+        common types of objects if they aren't traced"""
+        lines = ["Peak RSS: {0} KiB".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)]
+
+        if self.tracemalloc is not None:
+            snapshot = self.tracemalloc.take_snapshot()
+            self.tracemalloc.stop()
+
+            lines.append("Top {0} allocation sites:".format(PROFILE_TOP))
+            lines.extend(str(stat) for stat in
+                         snapshot.statistics("lineno")[:PROFILE_TOP])
+        else:
+            counts = {}
+            for obj in gc.get_objects():
+                name = type(obj).__name__
+                counts[name] = counts.get(name, 0) + 1
+
+            lines.append("Top {0} object types:".format(PROFILE_TOP))
+            lines.extend("{0}: {1}".format(name, count) for name, count in
+                         sorted(counts.items(), key=lambda item: -item[1])
+                         [:PROFILE_TOP])
+
+        return "\n".join(lines) + "\n"
+
+
+class ResponseCache(object):
+
+    def __init__(self):
+        """Initializor for an in-memory cache of
+        read-only RPC responses"""
+        logging.debug("Instantiating ResponseCache")
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def get(self, action, params):
+        """Returns the cached response for action and params,
+        or None if there isn't one"""
+        key = self._key(params)
+
+        with self._lock:
+            value = self._entries.get(action, {}).get(key)
+
+            if value is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+
+            return value
+
+    def set(self, action, params, value):
+        with self._lock:
+            self._entries.setdefault(action, {})[self._key(params)] = value
+
+    def lookup(self, action, params, name):
+        """Returns the structure, such as an index, stored under name
+        for the response to action and params, or None"""
+        with self._lock:
+            value = self._derived.get((action, self._key(params), name))
+
+            if value is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+
+            return value
+
+    def store(self, action, params, name, value):
+        """Keep a structure built from the response to action and
+        params. It is dropped along with cached responses"""
+        with self._lock:
+            self._derived[(action, self._key(params), name)] = value
+
+    def invalidate(self, mutation, params=None, data=None):
+        """Drop every entry made stale by the mutating action. data is
+        the response to a successful mutation, if there was one"""
+        with self._lock:
+            if mutation in HOST_MUTATIONS and params is not None:
+                self._forget_host(mutation, params, data)
+            elif mutation in INVALIDATES:
+                logging.debug("Invalidating cached {0}"
+                              .format(", ".join(INVALIDATES[mutation])))
+                for action in INVALIDATES[mutation]:
+                    self._entries.pop(action, None)
+
+                for key in self._derived.keys():
+                    if key[0] in INVALIDATES[mutation]:
+                        del self._derived[key]
+            else:
+                logging.debug("Invalidating all cached responses")
+                self._entries = {}
+                self._derived = {}
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _forget_host(self, mutation, params, data):
+        """Drop the entries describing the host changed by mutation,
+        so that the rest of a batch keeps using the cached listings.
+        Must be called with the cache lock held"""
+        record = data if isinstance(data, dict) else {}
+        hostid = record.get("id")
+        if HOST_MUTATIONS[mutation] is not None:
+            hostid = params.get(HOST_MUTATIONS[mutation], hostid)
+
+        hostid = str(hostid)
+        names = set([params.get("displayedAs"), record.get("displayedAs")])
+        logging.debug("Invalidating cached responses for host {0}"
+                      .format(hostid))
+
+        entries = self._entries.get("getHost", {})
+        for key, resp in entries.items():
+            host = resp.data if isinstance(resp.data, dict) else {}
+            if (str(host.get("id")) == hostid or
+               host.get("displayedAs") in names):
+                del entries[key]
+
+        # Adding or updating a host returns its new record, which
+        # answers the lookup made to refresh it
+        if (mutation in ["addHost", "updateHost"] and
+           "displayedAs" in record):
+            resp = RPCResponse(json.dumps({"status": 200,
+                                           "errmsg": "OK",
+                                           "data": record}))
+            resp.raw = None
+            self._entries.setdefault("getHost", {})[
+                self._key({"displayName": record["displayedAs"]})] = resp
+
+        entries = self._entries.get("getHostProperties", {})
+        for key in entries.keys():
+            if dict(urlparse.parse_qsl(key)).get("hostId") == hostid:
+                del entries[key]
+
+        # The raw listing is only needed to build the index, which is
+        # patched with the host's new record
+        self._entries.pop("getHosts", None)
+        for key in self._derived.keys():
+            if key[0] != "getHosts" or mutation == "setHostSDT":
+                continue
+
+            if "hostName" in record and "agentId" in record:
+                self._derived[key].discard(hostid)
+                self._derived[key].add(record)
+            elif mutation == "deleteHost":
+                self._derived[key].discard(hostid)
+            else:
+                del self._derived[key]
+
+    @staticmethod
+    def _key(params):
+        return urllib.urlencode(sorted(params.items()))
+
+
+class GroupIndex(object):
+
+    def __init__(self, groups=()):
+        """Initializor for an index of a getHostGroups listing
+        by fullPath, id and parentId"""
+        self.by_path = {}
+        self.by_id = {}
+        self.children = {}
+
+        for group in groups:
+            self.add(group)
+
+    def size(self):
+        return len(self.by_id)
+
+    def add(self, group):
+        self.by_path[group["fullPath"]] = group
+        self.by_id[group["id"]] = group
+        self.children.setdefault(group.get("parentId"), {})[
+            group.get("name")] = group
+
+    def get(self, fullpath):
+        """Returns the group matching the specified path or None"""
+        return self.by_path.get(fullpath.lstrip('/'))
+
+    def child(self, parentid, name):
+        """Returns the group named name under the group
+        with id parentid, or None"""
+        return self.children.get(parentid, {}).get(name)
+
+
+class LogicMonitorError(Exception):
+    """Raised in place of exiting the module when an
+    error occurs outside of the main thread"""
+    pass
+
+
+class LogicMonitorExit(Exception):
+    """Raised in place of exiting the module when an
+    object in a batch finishes early"""
+
+    def __init__(self, changed):
+        Exception.__init__(self, "Changed: {0}".format(changed))
+        self.changed = changed
+
+
+class Future(object):
+
+    def __init__(self):
+        """Initializor for the pending result of a ThreadPool task"""
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """Wait for the task and return its result, re-raising
+        any exception raised by the task"""
+        self._done.wait()
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+
+class ThreadPool(object):
+
+    def __init__(self, size):
+        """Initializor for a small pool of worker threads"""
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) and return its Future"""
+        future = Future()
+        self._queue.put((future, fn, args, kwargs))
+
+        if len(self._threads) < self.size:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        return future
+
+    def shutdown(self):
+        """Stop the workers once queued tasks are done
+        and wait for them to exit"""
+        for thread in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+
+            future, fn, args, kwargs = task
+            profiler = Profiler.active
+            try:
+                if profiler is not None:
+                    future.set_result(profiler.run(fn, *args, **kwargs))
+                else:
+                    future.set_result(fn(*args, **kwargs))
+            except BaseException:
+                future.set_exception(sys.exc_info())
+
+
+class Scheduler(object):
+
+    def __init__(self, size):
+        """Initializor for a set of calls which depend on each other.
+        Each call runs, on up to size threads at once, as soon as the
+        calls it depends on have succeeded. When a call fails only the
+        calls depending on it are skipped"""
+        self.size = size
+        self.results = {}
+        self.errors = {}
+        self._order = []
+        self._tasks = {}
+
+    def __contains__(self, key):
+        return key in self._tasks
+
+    def add(self, key, deps, fn, *args):
+        """Schedule fn(*args) to run once
+        every call in deps has succeeded"""
+        self._order.append(key)
+        self._tasks[key] = (list(deps), fn, args)
+
+    def run(self):
+        """Run every call and wait for them. Returns a hash of the
+        key of each call which failed or was skipped to its error"""
+        waiting = {}
+        dependents = {}
+        for key in self._order:
+            deps = set(dep for dep in self._tasks[key][0]
+                       if dep in self._tasks and dep != key)
+            waiting[key] = deps
+            for dep in deps:
+                dependents.setdefault(dep, []).append(key)
+
+        finished = Queue.Queue()
+        ready = [key for key in self._order if not waiting[key]]
+        running = 0
+
+        workers = ThreadPool(self.size)
+        try:
+            while ready or running:
+                for key in ready:
+                    deps, fn, args = self._tasks[key]
+                    workers.submit(self._call, finished, key, fn, args)
+                    running = running + 1
+                ready = []
+
+                key, result, error = finished.get()
+                running = running - 1
+
+                if error is None:
+                    self.results[key] = result
+                    for dependent in dependents.get(key, []):
+                        waiting[dependent].discard(key)
+                        if (not waiting[dependent] and
+                           dependent not in self.errors):
+                            ready.append(dependent)
+                else:
+                    logging.debug("{0} failed. {1}".format(key, error))
+                    self.errors[key] = error
+                    self._skip(key, dependents)
+        finally:
+            workers.shutdown()
+
+        # Anything left over depends on itself through a cycle
+        for key in self._order:
+            if key not in self.results and key not in self.errors:
+                self.errors[key] = LogicMonitorError(
+                    "Error: {0} has circular dependencies".format(key))
+
+        return self.errors
+
+    def _skip(self, key, dependents):
+        for dependent in dependents.get(key, []):
+            if dependent not in self.errors:
+                self.errors[dependent] = LogicMonitorError(
+                    "Error: Skipped because {0} failed".format(key))
+                self._skip(dependent, dependents)
+
+    @staticmethod
+    def _call(finished, key, fn, args):
+        try:
+            finished.put((key, fn(*args), None))
+        except Exception, e:
+            finished.put((key, None, e))
+
+
+class HostIndex(object):
+
+    def __init__(self, hosts=()):
+        """Initializor for an index of a getHosts
+        listing by (hostName, agentId)"""
+        self.by_name = {}
+        self.by_id = {}
+
+        for host in hosts:
+            self.add(host)
+
+    def size(self):
+        return len(self.by_name)
+
+    def add(self, host):
+        key = (host["hostName"], host["agentId"])
+        self.by_name[key] = host
+        self.by_id[str(host.get("id"))] = key
+
+    def discard(self, hostid):
+        """Remove the host with the id hostid, if it is indexed"""
+        key = self.by_id.pop(str(hostid), None)
+        if key is not None:
+            self.by_name.pop(key, None)
+
+    def get(self, hostname, agentid):
+        """Returns the host matching hostname and agentid or None"""
+        return self.by_name.get((hostname, agentid))
+
+
+class Delta(object):
+
+    def __init__(self):
+        """Initializor for the changes needed to make an object
+        in the LogicMonitor account match the supplied parameters"""
+        self.fields = {}
+        self.added = {}
+        self.changed = {}
+        self.removed = []
+        self.groups_added = []
+        self.groups_removed = []
+        self.optype = None
+
+    def __nonzero__(self):
+        return bool(self.fields or self.added or self.changed or
+                    self.removed or self.groups_added or
+                    self.groups_removed)
+
+    def compare(self, name, current, desired):
+        """Record the field name if its value differs"""
+        if current != desired:
+            logging.debug("Field {0} differs".format(name))
+            self.fields[name] = desired
+
+    def compare_properties(self, current, desired, prune=False):
+        """Record the desired properties missing from or differing
+        from the hash current. With prune, properties in current
+        that aren't desired are recorded as removed"""
+        for name, value in desired.iteritems():
+            if name not in current:
+                self.added[name] = value
+            elif current[name] != value:
+                self.changed[name] = value
+
+        if prune:
+            self.removed = sorted(name for name in current
+                                  if name not in desired)
+
+    def properties(self):
+        """Returns a hash of the properties which must be written"""
+        p = dict(self.added)
+        p.update(self.changed)
+        return p
+
+    def additive(self):
+        """Return true if the changes can be applied
+        without removing anything"""
+        return not self.removed and not self.groups_removed
+
+    def summary(self):
+        """Returns the changes, without any property
+        values, for the module result"""
+        return {"opType": self.optype,
+                "fields": sorted(self.fields),
+                "properties": {"added": sorted(self.added),
+                               "changed": sorted(self.changed),
+                               "removed": self.removed},
+                "groups": {"added": self.groups_added,
+                           "removed": self.groups_removed}}
+
+
+class RecordStream(object):
+
+    def __init__(self, f, path, chunk_size=65536):
+        """Initializor for an incremental parser which yields the
+        records of the JSON array found under the keys in path,
+        one at a time, while reading f in chunks. Scalar fields of
+        the top level object (status, errmsg) are kept in fields.
+        An error reading or decoding the response is kept in error"""
+        self.f = f
+        self.path = path
+        self.chunk_size = chunk_size
+        self.fields = {}
+        self.complete = False
+        self.error = None
+        self.size = 0
+        self.on_close = None
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def __iter__(self):
+        try:
+            for record in self._records():
+                yield record
+            self.complete = True
+        except (IOError, ValueError), e:
+            self.error = e
+            raise
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the underlying file. A response which wasn't read
+        to the end won't have its connection reused"""
+        if self.f is not None:
+            f, self.f = self.f, None
+            f.close()
+
+            if self.on_close is not None:
+                self.on_close(self)
+
+    def _records(self):
+        depth = 0
+        found = True
+
+        for key in self.path:
+            if self._peek() != "{":
+                self._decode()
+                found = False
+                break
+
+            if not self._enter(key, self.fields if depth == 0 else None):
+                found = False
+                break
+
+            depth = depth + 1
+
+        if found and self._peek() != "[":
+            self._decode()
+        elif found:
+            self._pos = self._pos + 1
+            while True:
+                c = self._peek()
+                if c == "]":
+                    self._pos = self._pos + 1
+                    break
+                elif c == ",":
+                    self._pos = self._pos + 1
+                elif c == "":
+                    raise ValueError("Unexpected end of JSON response")
+                else:
+                    yield self._decode()
+
+        # Pick up any fields following the array
+        for level in reversed(range(depth)):
+            self._leave(self.fields if level == 0 else None)
+
+    def _enter(self, key, store):
+        """Advance into the value of key in the object at the current
+        position, saving skipped values in store. Returns False,
+        having consumed the object, if it has no such key"""
+        self._expect("{")
+
+        while True:
+            c = self._peek()
+            if c == ",":
+                self._pos = self._pos + 1
+                continue
+            elif c == "}":
+                self._pos = self._pos + 1
+                return False
+
+            name = self._decode()
+            self._expect(":")
+
+            if name == key:
+                return True
+
+            value = self._decode()
+            if store is not None:
+                store[name] = value
+
+    def _leave(self, store):
+        """Consume the rest of the current object"""
+        while True:
+            c = self._peek()
+            if c == ",":
+                self._pos = self._pos + 1
+                continue
+            elif c == "}" or c == "":
+                self._pos = self._pos + 1
+                return
+
+            name = self._decode()
+            self._expect(":")
+
+            value = self._decode()
+            if store is not None:
+                store[name] = value
+
+    def _expect(self, c):
+        if self._peek() != c:
+            raise ValueError("Expected '{0}' in JSON response".format(c))
+        self._pos = self._pos + 1
+
+    def _peek(self):
+        """Returns the next non-whitespace character, or an
+        empty string at the end of the response"""
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in " \t\r\n"):
+                self._pos = self._pos + 1
+
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+
+            if not self._fill():
+                return ""
+
+    def _decode(self):
+        """Decode the JSON value at the current position,
+        reading more of the response until it is complete"""
+        while True:
+            self._peek()
+
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+
+            # A number at the end of the buffer may continue in the
+            # next chunk
+            if end == len(self._buf) and self._fill():
+                continue
+
+            self._pos = end
+            return value
+
+    def _fill(self):
+        """Drop consumed input and read the next chunk.
+        Returns False at the end of the response"""
+        if self._eof or self.f is None:
+            return False
+
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self._eof = True
+            return False
+
+        self.size = self.size + len(data)
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+
+class ResponseRecords(object):
+
+    def __init__(self, resp, path):
+        """Initializor for a RecordStream lookalike over the array
+        under path in an already decoded RPCResponse"""
+        self.resp = resp
+        self.path = path
+        self.fields = {"status": resp.status, "errmsg": resp.errmsg}
+        self.complete = False
+
+    def __iter__(self):
+        records = self.resp.data
+        for key in self.path[1:]:
+            records = (records or {}).get(key)
+
+        for record in records or []:
+            yield record
+        self.complete = True
+
+    def close(self):
+        pass
+
+
 class LogicMonitor(object):
 
+    # Connection pools and response caches are shared by every object
+    # in the process so that consecutive tasks reuse connections and
+    # responses
+    _pools = {}
+    _caches = {}
+    _stats = {}
+    _limiters = {}
+    _breakers = {}
+    _latencies = {}
+    _shared_lock = threading.Lock()
+    _index_lock = threading.Lock()
+    _groups_lock = threading.Lock()
+
+    # Task deadlines are measured from when the module was loaded
+    _started = time.time()
+
     def __init__(self, module, **params):
         self.__version__ = "1.0-python"
 
@@ -573,59 +3089,314 @@ class LogicMonitor(object):
         logging.debug("Instantiating LogicMonitor object")
 
         self.check_mode = False
+        self.change = False
+        self.batch = bool(params.get("batch"))
+        self.delta = None
         self.company = params["company"]
         self.user = params["user"]
         self.password = params["password"]
+        self.timeout = int(params.get("timeout") or 30)
+        self.retries = int(params.get("retries") or 0)
+        self.deadline = None
+        if int(params.get("deadline") or 0) > 0:
+            self.deadline = self._started + int(params["deadline"])
         self.fqdn = socket.getfqdn()
         self.lm_url = "logicmonitor.com/santaba"
 
-        # Grab the Ansible module if provided
-        try:
-            self.module = module
-            self.urlopen = open_url  # use the ansible provided open_url
+        self.module = module
+        if self.module is not None:
             self.__version__ = self.__version__ + "-ansible-module"
-        except:
-            self.module = None
-            self.urlopen = urllib2.urlopen
+
+        self.pool = self.get_pool("{0}.{1}".format(
+            self.company, self.lm_url.split("/", 1)[0]))
+        self.cache = self.get_cache(self.company, self.user)
+        self.rpc_stats = self.get_stats(self.company)
+
+        # Optional cache of account listings shared with other forks
+        self.cache_dir = (params.get("cache_dir") or
+                          os.path.join(tempfile.gettempdir(),
+                                       "ansible-logicmonitor-{0}"
+                                       .format(os.getuid())))
+
+        # Requests are rate limited across every fork on the controller
+        self.limiter = self.get_limiter(self.company,
+                                        float(params.get("rate_limit") or 0),
+                                        self.cache_dir)
+
+        # Optional circuit breaker failing fast during outages
+        self.breaker = self.get_breaker(
+            self.company,
+            int(params.get("circuit_threshold") or 0),
+            int(params.get("circuit_reset") or 60),
+            self.cache_dir)
+
+        # Optional hedging of slow reads
+        self.hedge_percentile = int(params.get("hedge_percentile") or 0)
+        self.latency = None
+        if self.hedge_percentile > 0:
+            self.latency = self.get_latency(self.company, self.cache_dir)
+        self.shared_cache = None
+        if int(params.get("cache_ttl") or 0) > 0:
+            self.shared_cache = SharedCache(self.cache_dir,
+                                            self.company,
+                                            self.user,
+                                            int(params["cache_ttl"]))
+
+        # Optional cache of masked property verifications
+        self.verify_cache = None
+        if int(params.get("verify_ttl") or 0) > 0:
+            self.verify_cache = VerifyCache(self.cache_dir,
+                                            self.company,
+                                            self.user,
+                                            int(params["verify_ttl"]))
+
+        # Optional record of the desired state last applied to each object
+        self.state_store = None
+        if params.get("state_cache"):
+            self.state_store = StateStore(self.cache_dir,
+                                          self.company,
+                                          self.user)
+
+    @classmethod
+    def get_pool(cls, host):
+        """Returns the shared connection pool for host"""
+        with cls._shared_lock:
+            if host not in cls._pools:
+                cls._pools[host] = ConnectionPool(host)
+            return cls._pools[host]
+
+    @classmethod
+    def get_cache(cls, company, user):
+        """Returns the shared response cache for an account user"""
+        with cls._shared_lock:
+            if (company, user) not in cls._caches:
+                cls._caches[(company, user)] = ResponseCache()
+            return cls._caches[(company, user)]
+
+    @classmethod
+    def get_stats(cls, company):
+        """Returns the record of RPC calls made to an account"""
+        with cls._shared_lock:
+            if company not in cls._stats:
+                cls._stats[company] = RPCStats()
+            return cls._stats[company]
+
+    @classmethod
+    def get_limiter(cls, company, rate, directory):
+        """Returns the rate limiter for an account. The bucket is
+        shared with other processes through directory when possible"""
+        key = (company, rate, directory)
+
+        with cls._shared_lock:
+            if key not in cls._limiters:
+                limiter = None
+                if rate > 0:
+                    try:
+                        limiter = SharedRateLimiter(rate, directory, company)
+                    except OSError, e:
+                        logging.debug("Unable to share the rate limit. {0}"
+                                      .format(e))
+
+                cls._limiters[key] = limiter or RateLimiter(rate)
+            return cls._limiters[key]
+
+    @classmethod
+    def get_breaker(cls, company, threshold, reset, directory):
+        """Returns the circuit breaker for an account,
+        or None if threshold is 0"""
+        if threshold <= 0:
+            return None
+
+        key = (company, threshold, reset, directory)
+
+        with cls._shared_lock:
+            if key not in cls._breakers:
+                try:
+                    cls._breakers[key] = CircuitBreaker(threshold, reset,
+                                                        directory, company)
+                except OSError, e:
+                    logging.debug("Unable to create the circuit breaker. {0}"
+                                  .format(e))
+                    return None
+            return cls._breakers[key]
+
+    @classmethod
+    def get_latency(cls, company, directory):
+        """Returns the record of recent request latencies for an account,
+        or None if it can't be kept"""
+        key = (company, directory)
+
+        with cls._shared_lock:
+            if key not in cls._latencies:
+                try:
+                    cls._latencies[key] = LatencyTracker(directory, company)
+                except OSError, e:
+                    logging.debug("Unable to record latencies. {0}"
+                                  .format(e))
+                    return None
+            return cls._latencies[key]
 
     def rpc(self, action, params):
         """Make a call to the LogicMonitor RPC library
-        and return the response"""
+        and return the response as an RPCResponse. Successful
+        read-only calls are cached until a mutating call makes
+        them stale"""
         logging.debug("Running LogicMonitor.rpc")
+        started = self.rpc_stats.start()
+        resp = None
 
-        param_str = urllib.urlencode(params)
-        creds = urllib.urlencode(
-            {"c": self.company,
-                "u": self.user,
-                "p": self.password})
+        try:
+            resp = self._cached_rpc(action, params)
+            return resp
+        finally:
+            self.rpc_stats.record(
+                action, RPCStats.caller(sys._getframe(1)), started,
+                resp.size if resp is not None else 0,
+                resp is not None and resp.status == 200,
+                self.rpc_stats.requests())
+
+    def _cached_rpc(self, action, params):
+        """Return the response to an RPC call from
+        cache, or from the server if it isn't cached"""
+        cacheable = action in READ_ACTIONS
+
+        if cacheable:
+            resp = self.cache.get(action, params)
+            if resp is not None:
+                logging.debug("Using cached '{0}' response".format(action))
+                return resp
 
-        if param_str:
-            param_str = param_str + "&"
+        if (cacheable and self.shared_cache is not None and
+           action in SHARED_ACTIONS):
+            resp = self.shared_cache.fetch(action, params, self._rpc)
+        else:
+            resp = self._rpc(action, params)
 
-        param_str = param_str + creds
+        if resp is None:
+            return None
 
-        try:
-            url = ("https://{0}.{1}/rpc/{2}?{3}"
-                   .format(self.company, self.lm_url, action, param_str))
+        # The decoded response is all callers need
+        resp.raw = None
+
+        if cacheable:
+            if resp.status == 200:
+                self.cache.set(action, params, resp)
+        elif action not in UNCACHED_ACTIONS:
+            self.cache.invalidate(
+                action, params, resp.data if resp.status == 200 else None)
+            if self.shared_cache is not None:
+                self.shared_cache.invalidate(action)
+            if (self.verify_cache is not None and
+               action in WRITES_PROPERTIES):
+                self._forget_verified(action, params)
+
+        if resp.status == 403:
+            logging.debug("Authentication failed.")
+            self.fail(msg="Error: {0}".format(resp.errmsg))
+        else:
+            return resp
 
-            # Set custom LogicMonitor header with version
-            headers = {"X-LM-User-Agent": self.__version__}
+    def _forget_verified(self, action, params):
+        """Drop cached verifications of the properties
+        overwritten by a mutating call"""
+        kind, key = WRITES_PROPERTIES[action]
+        target = {kind: params.get(key)}
 
-            # Set headers dependent on Ansible or normal usage
-            if self.module is not None:
-                f = self.urlopen(url, headers=headers)
-            else:
-                req = urllib2.Request(url)
-                req.add_header("X-LM-User-Agent", self.__version__)
-                f = self.urlopen(req)
-
-            raw = f.read()
-            resp = json.loads(raw)
-            if resp["status"] == 403:
-                logging.debug("Authentication failed.")
-                self.fail(msg="Error: {0}".format(resp["errmsg"]))
+        if action.startswith("delete"):
+            self.verify_cache.forget(target)
+        else:
+            self.verify_cache.forget(
+                target, set(value for name, value in params.items()
+                            if name.startswith("propName")))
+
+    def rpc_stream(self, action, params, path):
+        """Make a call to the LogicMonitor RPC library and return a
+        RecordStream over the array under path in the response, so
+        that large listings are decoded one record at a time"""
+        logging.debug("Running LogicMonitor.rpc_stream")
+        caller = RPCStats.caller(sys._getframe(1))
+        started = self.rpc_stats.start()
+        stream = None
+
+        try:
+            stream = self._open_stream(action, params, path)
+        finally:
+            requests = self.rpc_stats.requests()
+            if not isinstance(stream, RecordStream):
+                self.rpc_stats.record(action, caller, started, 0,
+                                      stream is not None, requests)
+
+        if isinstance(stream, RecordStream):
+            # The call lasts until the response has been read
+            stream.on_close = lambda s: self.rpc_stats.record(
+                action, caller, started, s.size,
+                s.error is None and s.fields.get("status") == 200,
+                requests)
+
+        return stream
+
+    def _open_stream(self, action, params, path):
+        """Return a RecordStream over the response to an RPC call,
+        or a ResponseRecords over it if the response is cached"""
+        resp = self.cache.get(action, params)
+        if resp is not None:
+            logging.debug("Using cached '{0}' response".format(action))
+            return ResponseRecords(resp, path)
+
+        try:
+            if (self.shared_cache is not None and
+               action in SHARED_ACTIONS):
+                f = self.shared_cache.open(action, params, self._rpc)
             else:
-                return raw
+                f = self._retry(
+                    action, lambda: self._request("rpc", action, params))
+        except (CircuitOpenError, DeadlineError), e:
+            self.fail(msg=str(e))
+        except IOError, ioe:
+            logging.debug(ioe)
+            self.fail(msg="Error: Unknown exception making RPC call")
+
+        if f is None:
+            return None
+
+        return RecordStream(f, path)
+
+    def _read_stream(self, action, stream):
+        """Yield the records of stream. A response which can't be
+        read to the end fails the task like a failed request"""
+        try:
+            for record in stream:
+                yield record
+        except (IOError, ValueError), e:
+            logging.debug(e)
+            if self.breaker is not None:
+                self.breaker.failure()
+            self.fail(msg="Error: Unable to read the '{0}' response. {1}"
+                      .format(action, e))
+
+    def _stream_ok(self, action, stream):
+        """Check the status of a completely read RecordStream"""
+        status = stream.fields.get("status")
+
+        if status == 200:
+            logging.debug("RPC call succeeded")
+            return True
+        elif status == 403:
+            logging.debug("Authentication failed.")
+            self.fail(msg="Error: {0}".format(stream.fields.get("errmsg")))
+        else:
+            logging.debug("RPC call to '{0}' failed".format(action))
+            logging.debug(stream.fields)
+        return False
+
+    def _rpc(self, action, params):
+        """Send the RPC request to the server and return
+        the RPCResponse"""
+        try:
+            return self._retry(action, lambda: RPCResponse(
+                self._request("rpc", action, params).read()))
+        except (CircuitOpenError, DeadlineError), e:
+            self.fail(msg=str(e))
         except IOError, ioe:
             logging.debug(ioe)
             self.fail(msg="Error: Unknown exception making RPC call")
@@ -634,31 +3405,249 @@ class LogicMonitor(object):
         """Make a call to the LogicMonitor
          server \"do\" function"""
         logging.debug("Running LogicMonitor.do...")
+        started = self.rpc_stats.start()
+        resp = None
+
+        try:
+            logging.debug("Attempting to open URL: " +
+                          "https://{0}.{1}/do/{2}"
+                          .format(self.company, self.lm_url, action))
+            resp = self._retry(
+                action, lambda: self._request("do", action, params).read())
+            return resp
+        except (CircuitOpenError, DeadlineError), e:
+            self.fail(msg=str(e))
+        except IOError, ioe:
+            logging.debug("Error opening URL. {0}".format(ioe))
+            self.fail("Unknown exception opening URL")
+        finally:
+            self.rpc_stats.record(
+                action, RPCStats.caller(sys._getframe(1)), started,
+                len(resp) if resp is not None else 0,
+                resp is not None, self.rpc_stats.requests())
+
+    def _retry(self, action, call):
+        """Return the result of call() once the rate limiter allows
+        it. Requests the server throttled are retried, as are requests
+        for read-only actions which failed with transient errors.
+        Raises CircuitOpenError without sending the request while the
+        account's circuit breaker is open, and DeadlineError once the
+        task's deadline has passed"""
+        idempotent = action in READ_ACTIONS or action in UNCACHED_ACTIONS
+        breaker = self.breaker
+        attempt = 0
+
+        while True:
+            if self._remaining() <= 0:
+                raise self._deadline_error("before", action)
+
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError(breaker.error())
+
+            self.limiter.acquire()
+            self.rpc_stats.sent()
+            delay = None
+
+            try:
+                result = self._send(action, call)
+
+                if breaker is not None:
+                    if (isinstance(result, RPCResponse) and
+                       result.status >= 500 and result.status != 429):
+                        breaker.failure()
+                    else:
+                        breaker.success()
+
+                if (not isinstance(result, RPCResponse) or
+                   result.status not in THROTTLE_STATUS):
+                    self.limiter.succeeded()
+                    return result
+
+                logging.debug("'{0}' was throttled".format(action))
+                throttled = True
+                if attempt >= self.retries:
+                    return result
+            except urllib2.HTTPError, e:
+                if breaker is not None:
+                    if e.code >= 500 and e.code != 429:
+                        breaker.failure()
+                    else:
+                        breaker.success()
+
+                throttled = e.code in THROTTLE_STATUS
+                if (attempt >= self.retries or
+                   not (throttled or (idempotent and e.code >= 500))):
+                    raise
+
+                logging.debug("'{0}' failed. {1}".format(action, e))
+                delay = self._retry_after(e.hdrs)
+            except IOError, e:
+                # Connection errors and time outs. Requests time out
+                # early when the task's deadline is near
+                if self._remaining() <= 0:
+                    raise self._deadline_error("during", action)
+
+                if breaker is not None:
+                    breaker.failure()
+
+                throttled = False
+                if attempt >= self.retries or not idempotent:
+                    raise
+
+                logging.debug("'{0}' failed. {1}".format(action, e))
+
+            attempt = attempt + 1
+            self.limiter.backoff(attempt, delay, throttled,
+                                 self._remaining())
+
+    def _deadline_error(self, when, action):
+        """Returns the DeadlineError reporting that the task's
+        deadline passed when ("before" or "during") a request
+        to action was sent"""
+        return DeadlineError(
+            "Error: Deadline of {0} seconds exceeded {1} '{2}'"
+            .format(int(self.deadline - self._started), when, action))
+
+    def _remaining(self):
+        """Returns the number of seconds left before the task's
+        deadline, or infinity if there is no deadline"""
+        if self.deadline is None:
+            return float("inf")
+
+        return self.deadline - time.time()
+
+    def _send(self, action, call):
+        """Return the result of call(), learning the latency of action.
+        Reads slower than the hedge percentile of recent requests are
+        sent a second time and the first reply wins"""
+        if self.latency is None or action not in READ_ACTIONS:
+            return call()
+
+        threshold = self.latency.percentile(action, self.hedge_percentile)
+        started = time.time()
+
+        if threshold is None or threshold >= self._remaining():
+            result = call()
+        else:
+            result = self._hedge(action, call, threshold)
+
+        self.latency.record(action, time.time() - started)
+        return result
+
+    def _hedge(self, action, call, threshold):
+        """Call call() and, if it hasn't returned within threshold
+        seconds, call it again. Returns the first successful result.
+        A result which arrives after the winner is closed"""
+        replies = Queue.Queue()
+        state = {"done": False}
+        lock = threading.Lock()
+
+        def attempt(hedge):
+            try:
+                reply = (hedge, call(), None)
+            except BaseException:
+                reply = (hedge, None, sys.exc_info())
+
+            with lock:
+                if not state["done"]:
+                    replies.put(reply)
+                    return
+
+            self._discard(reply)
+
+        def start(hedge):
+            thread = threading.Thread(target=attempt, args=(hedge,))
+            thread.daemon = True
+            thread.start()
+
+        # Timed waits poll in Python 2, so a timer wakes us up
+        # to send the hedged request instead
+        timer = threading.Timer(threshold, replies.put, args=(None,))
+        timer.daemon = True
+
+        start(False)
+        timer.start()
+        reply = replies.get()
+        timer.cancel()
+
+        if reply is None:
+            logging.debug("Hedging '{0}' after {1:.3f} seconds"
+                          .format(action, threshold))
+            self.limiter.acquire()
+            start(True)
+
+            reply = replies.get()
+            if reply[2] is not None:
+                # Wait for the other request rather than fail
+                reply = replies.get()
+            self.latency.hedge(reply[0])
+
+        with lock:
+            state["done"] = True
+
+        while not replies.empty():
+            self._discard(replies.get_nowait())
+
+        hedge, result, exc_info = reply
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return result
+
+    @staticmethod
+    def _discard(reply):
+        """Release the connection held by a losing hedged reply"""
+        if reply is None:
+            return
+
+        close = getattr(reply[1], "close", None)
+        if close is not None:
+            close()
+
+    @staticmethod
+    def _retry_after(headers):
+        """Returns the number of seconds in a Retry-After
+        header, or None if there isn't one"""
+        value = headers.getheader("Retry-After") if headers else None
+        if not value:
+            return None
 
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            date = parsedate_tz(value)
+            if date is None:
+                return None
+            return max(0.0, mktime_tz(date) - time.time())
+
+    def _request(self, kind, action, params):
+        """Send an authenticated request for /kind/action through
+        the connection pool and return the PooledResponse"""
         param_str = urllib.urlencode(params)
-        creds = (urllib.urlencode(
+        creds = urllib.urlencode(
             {"c": self.company,
                 "u": self.user,
-                "p": self.password}))
+                "p": self.password})
 
         if param_str:
             param_str = param_str + "&"
         param_str = param_str + creds
 
-        try:
-            logging.debug("Attempting to open URL: " +
-                          "https://{0}.{1}/do/{2}?{3}"
-                          .format(self.company,
-                                  self.lm_url,
-                                  action,
-                                  param_str))
-            f = self.urlopen(
-                "https://{0}.{1}/do/{2}?{3}"
-                .format(self.company, self.lm_url, action, param_str))
-            return f.read()
-        except IOError, ioe:
-            logging.debug("Error opening URL. {0}".format(ioe))
-            self.fail("Unknown exception opening URL")
+        path = "/{0}/{1}/{2}?{3}".format(
+            self.lm_url.split("/", 1)[1], kind, action, param_str)
+
+        # Set custom LogicMonitor header with version
+        headers = {"X-LM-User-Agent": self.__version__}
+
+        # Never wait on a response past the task's deadline
+        timeout = max(0.1, min(self.timeout, self._remaining()))
+
+        if not VERIFIES_CERTS:
+            # Leave certificate checks to Ansible on older Pythons
+            return open_url("https://{0}{1}".format(self.pool.host, path),
+                            headers=headers, timeout=timeout)
+
+        return self.pool.urlopen(path, headers, timeout)
 
     def get_collectors(self):
         """Returns a JSON object containing a list of
@@ -667,47 +3656,87 @@ class LogicMonitor(object):
 
         logging.debug("Making RPC call to 'getAgents'")
         resp = self.rpc("getAgents", {})
-        resp_json = json.loads(resp)
 
-        if resp_json["status"] is 200:
+        if resp.status is 200:
             logging.debug("RPC call succeeded")
-            return resp_json["data"]
+            return resp.data
         else:
-            self.fail(msg=resp)
+            self.fail(msg=resp.errmsg)
 
     def get_host_by_hostname(self, hostname, collector):
         """Returns a host object for the host matching the
         specified hostname"""
         logging.debug("Running LogicMonitor.get_host_by_hostname...")
 
+        if not collector:
+            logging.debug("No collector specified")
+            return None
+
         logging.debug("Looking for hostname {0}".format(hostname))
-        logging.debug("Making RPC call to 'getHosts'")
-        hostlist_json = json.loads(self.rpc("getHosts", {"hostGroupId": 1}))
 
-        if collector:
-            if hostlist_json["status"] == 200:
-                logging.debug("RPC call succeeded")
+        # The API can't filter hosts by hostname, but devices are usually
+        # displayed under their hostname so try that single lookup first
+        if hostname != getattr(self, "displayname", None):
+            host = self.get_host_by_displayname(hostname)
+
+            if (host is not None and
+               host.get("hostName") == hostname and
+               host.get("agentId") == collector["id"]):
 
-                hosts = hostlist_json["data"]["hosts"]
+                logging.debug("Host match found")
+                return host
 
-                logging.debug(
-                    "Looking for host matching: hostname {0} and collector {1}"
-                    .format(hostname, collector["id"]))
+        logging.debug(
+            "Looking for host matching: hostname {0} and collector {1}"
+            .format(hostname, collector["id"]))
 
-                for host in hosts:
-                    if (host["hostName"] == hostname and
-                       host["agentId"] == collector["id"]):
+        params = {"hostGroupId": 1}
+        index = self.cache.lookup("getHosts", params, "index")
 
-                        logging.debug("Host match found")
-                        return host
-                logging.debug("No host match found")
+        if index is None and self.batch:
+            # Other hosts in the batch are likely to need the whole
+            # listing too, so fetch it once for all of them
+            with self._index_lock:
+                index = self.get_host_index()
+
+        if index is not None:
+            host = index.get(hostname, collector["id"])
+        else:
+            # Index the listing as it streams in and stop reading
+            # as soon as the host turns up
+            logging.debug("Making RPC call to 'getHosts'")
+            stream = self.rpc_stream("getHosts", params, ["data", "hosts"])
+            if stream is None:
                 return None
-            else:
-                logging.debug("RPC call failed")
-                logging.debug(hostlist_json)
+
+            index = HostIndex()
+            host = None
+            try:
+                for record in self._read_stream("getHosts", stream):
+                    index.add(record)
+                    if (record["hostName"] == hostname and
+                       record["agentId"] == collector["id"]):
+                        host = record
+                        break
+            finally:
+                stream.close()
+
+            if stream.complete and self._stream_ok("getHosts", stream):
+                self.cache.store("getHosts", params, "index", index)
+
+        if host is not None:
+            logging.debug("Host match found")
         else:
-            logging.debug("No collector specified")
-            return None
+            logging.debug("No host match found")
+        return host
+
+    def get_host_index(self):
+        """Returns a HostIndex of every host in the account. The
+        index is built once per getHosts listing"""
+        logging.debug("Running LogicMonitor.get_host_index...")
+
+        return self._get_index("getHosts", {"hostGroupId": 1},
+                               ["data", "hosts"], HostIndex)
 
     def get_host_by_displayname(self, displayname):
         """Returns a host object for the host matching the
@@ -716,12 +3745,11 @@ class LogicMonitor(object):
 
         logging.debug("Looking for displayname {0}".format(displayname))
         logging.debug("Making RPC call to 'getHost'")
-        host_json = (json.loads(self.rpc("getHost",
-                                {"displayName": displayname})))
+        host_json = self.rpc("getHost", {"displayName": displayname})
 
-        if host_json["status"] == 200:
+        if host_json.status == 200:
             logging.debug("RPC call succeeded")
-            return host_json["data"]
+            return host_json.data
         else:
             logging.debug("RPC call failed")
             logging.debug(host_json)
@@ -743,114 +3771,481 @@ class LogicMonitor(object):
         logging.debug("No collector match found")
         return None
 
+    def get_group_index(self):
+        """Returns a GroupIndex of the account's host groups. The
+        index is built once per getHostGroups listing"""
+        logging.debug("Running LogicMonitor.get_group_index...")
+
+        return self._get_index("getHostGroups", {}, ["data"], GroupIndex)
+
+    def _get_index(self, action, params, path, cls):
+        """Returns the cached index of the listing returned by action,
+        or builds one of type cls from the streamed listing"""
+        index = self.cache.lookup(action, params, "index")
+        if index is not None:
+            return index
+
+        logging.debug("Making RPC call to '{0}'".format(action))
+        stream = self.rpc_stream(action, params, path)
+        if stream is None:
+            return None
+
+        index = cls()
+        for record in self._read_stream(action, stream):
+            index.add(record)
+
+        if not self._stream_ok(action, stream):
+            return None
+
+        logging.debug("Indexed {0} records from '{1}'"
+                      .format(index.size(), action))
+        self.cache.store(action, params, "index", index)
+        return index
+
     def get_group(self, fullpath):
         """Returns a JSON group object for the group matching the
         specified path"""
         logging.debug("Running LogicMonitor.get_group...")
 
-        logging.debug("Making RPC call to getHostGroups")
-        resp = json.loads(self.rpc("getHostGroups", {}))
-
-        if resp["status"] == 200:
-            logging.debug("RPC called succeeded")
-            groups = resp["data"]
+        index = self.get_group_index()
 
+        if index is not None:
             logging.debug("Looking for group matching {0}".format(fullpath))
-            for group in groups:
-                if group["fullPath"] == fullpath.lstrip('/'):
-                    logging.debug("Group match found")
-                    return group
+            group = index.get(fullpath)
 
-            logging.debug("No group match found")
-            return None
-        else:
-            logging.debug("RPC call failed")
-            logging.debug(resp)
+            if group is not None:
+                logging.debug("Group match found")
+            else:
+                logging.debug("No group match found")
+            return group
 
         return None
 
     def create_group(self, fullpath):
-        """Recursively create a path of host groups.
-        Returns the id of the newly created hostgroup"""
+        """Create a path of host groups.
+        Returns the id of the hostgroup"""
         logging.debug("Running LogicMonitor.create_group...")
 
-        res = self.get_group(fullpath)
-        if res:
-            logging.debug("Group {0} exists.".format(fullpath))
-            return res["id"]
+        return self.ensure_groups([fullpath])[fullpath]
+
+    def ensure_groups(self, fullpaths):
+        """Make sure every host group path in fullpaths exists.
+        Missing groups are found against a single group listing and
+        created parents first, independent groups concurrently.
+        Returns a hash of each path to its group id"""
+        logging.debug("Running LogicMonitor.ensure_groups...")
+
+        # Hosts in a batch often share groups. Let one create
+        # them and the others find them in the group index.
+        with self._groups_lock:
+            scheduler = Scheduler(GROUP_WORKERS)
+            ids = self.schedule_groups(scheduler, fullpaths)
+            errors = scheduler.run()
+
+        if errors:
+            # Report the failure nearest the root
+            self.fail(msg=str(errors[sorted(errors)[0]]))
+
+        return dict((fullpath, ids.get(self._normalize_path(fullpath)))
+                    for fullpath in fullpaths)
+
+    def schedule_groups(self, scheduler, fullpaths):
+        """Add a call to scheduler creating each missing group on the
+        paths in fullpaths, keyed by its normalized path and depending
+        on its parent. Returns a hash of normalized paths to group ids,
+        filled in for missing groups as the scheduler creates them"""
+        index = self.get_group_index()
+        ids = {"/": 1}
+        missing = []
+
+        for fullpath in fullpaths:
+            path = ""
+            for name in self._normalize_path(fullpath).split("/")[1:]:
+                if not name:
+                    continue
+
+                parent = path or "/"
+                path = path + "/" + name
+                if path in ids or path in missing:
+                    continue
+
+                # Groups under a missing parent are missing too
+                group = None
+                if index is not None and parent in ids:
+                    group = index.child(ids[parent], name)
+
+                if group:
+                    logging.debug("Group {0} exists.".format(path))
+                    ids[path] = group["id"]
+                else:
+                    missing.append(path)
 
-        if fullpath == "/":
-            logging.debug("Specified group is root. Doing nothing.")
-            return 1
-        else:
-            logging.debug("Creating group named {0}".format(fullpath))
+        if missing:
+            logging.debug("Creating groups {0}"
+                          .format(", ".join(sorted(missing))))
             logging.debug("System changed")
             self.change = True
 
             if self.check_mode:
                 self.exit(changed=True)
 
-            parentpath, name = fullpath.rsplit('/', 1)
-            parentgroup = self.get_group(parentpath)
+        def create(path, parent):
+            ids[path] = self._add_group(path, ids[parent])
 
-            parentid = 1
+        for path in missing:
+            parent = path.rsplit("/", 1)[0] or "/"
+            scheduler.add(path, [parent], create, path, parent)
 
-            if parentpath == "":
-                parentid = 1
-            elif parentgroup:
-                parentid = parentgroup["id"]
-            else:
-                parentid = self.create_group(parentpath)
-
-            h = None
-
-            # Determine if we're creating a group from host or hostgroup class
-            if hasattr(self, '_build_host_group_hash'):
-                h = self._build_host_group_hash(
-                    fullpath,
-                    self.description,
-                    self.properties,
-                    self.alertenable)
-                h["name"] = name
-                h["parentId"] = parentid
-            else:
-                h = {"name": name,
-                     "parentId": parentid,
-                     "alertEnable": True,
-                     "description": ""}
+        return ids
 
-            logging.debug("Making RPC call to 'addHostGroup'")
-            resp = json.loads(
-                self.rpc("addHostGroup", h))
+    def _add_group(self, fullpath, parentid):
+        """Create a single host group under parentid.
+        Returns the id of the new hostgroup"""
+        logging.debug("Creating group named {0}".format(fullpath))
 
-            if resp["status"] == 200:
-                logging.debug("RPC call succeeded")
-                return resp["data"]["id"]
-            elif resp["errmsg"] == "The record already exists":
-                logging.debug("The hostgroup already exists")
-                group = self.get_group(fullpath)
-                return group["id"]
+        name = fullpath.rsplit('/', 1)[1]
+        h = None
+
+        # Determine if we're creating a group from host or hostgroup class
+        if hasattr(self, '_build_host_group_hash'):
+            h = self._build_host_group_hash(
+                fullpath,
+                self.description,
+                self.properties,
+                self.alertenable,
+                parentid)
+            h["name"] = name
+            h["parentId"] = parentid
+        else:
+            h = {"name": name,
+                 "parentId": parentid,
+                 "alertEnable": True,
+                 "description": ""}
+
+        logging.debug("Making RPC call to 'addHostGroup'")
+        resp = self.rpc("addHostGroup", h)
+
+        if resp.status == 200:
+            logging.debug("RPC call succeeded")
+            return resp.data["id"]
+        elif resp.errmsg == "The record already exists":
+            logging.debug("The hostgroup already exists")
+            group = self.get_group(fullpath)
+            return group["id"]
+        else:
+            logging.debug("RPC call failed")
+            self.fail(
+                msg="Error: unable to create new hostgroup \"{0}\".\n{1}"
+                .format(name, resp.errmsg))
+
+    @staticmethod
+    def _normalize_path(fullpath):
+        """Returns fullpath with a single leading slash and
+        no empty segments"""
+        names = [name.strip() for name in fullpath.split("/")]
+        return "/" + "/".join(name for name in names if name)
+
+    def _gather(self, futures):
+        """Wait for futures and return their results. Errors raised
+        by worker threads are reported through self.fail"""
+        results = []
+        error = None
+
+        for future in futures:
+            try:
+                results.append(future.result())
+            except LogicMonitorError, e:
+                error = error or e
+                results.append(None)
+
+        if error is not None:
+            self.fail(msg=str(error))
+
+        return results
+
+    def verify_properties(self, target, properties):
+        """Check with the LogicMonitor server whether the values in
+        properties match those stored on the object identified by
+        target, e.g. {"hostId": 12}. All values are sent in a single
+        verifyProperties call. Returns a hash of name to match"""
+        logging.debug("Running LogicMonitor.verify_properties...")
+
+        if self.verify_cache is None:
+            return self._verify_batch(target, properties)
+
+        result = dict((name, True) for name in
+                      self.verify_cache.lookup(target, properties))
+        logging.debug("{0} of {1} properties verified from cache"
+                      .format(len(result), len(properties)))
+
+        verified = self._verify_batch(
+            target, dict((name, value) for name, value in properties.items()
+                         if name not in result))
+        self.verify_cache.remember(
+            target, dict((name, properties[name]) for name, match
+                         in verified.items() if match))
+
+        result.update(verified)
+        return result
+
+    def is_current(self):
+        """Return true if the supplied parameters were the last
+        ones applied to this object and it hasn't been modified
+        since. Only the already fetched object is consulted"""
+        if self.state_store is None or not self.info:
+            return False
+
+        return self.state_store.is_current(self.state_key(),
+                                           self._desired_state(),
+                                           self._marker())
+
+    def record_state(self):
+        """Remember that the supplied parameters are
+        now applied to this object"""
+        if self.state_store is not None and self.info:
+            logging.debug("Recording applied state")
+            self.state_store.record(self.state_key(),
+                                    self._desired_state(),
+                                    self._marker())
+
+    def _desired_state(self):
+        return dict((name, self.params.get(name))
+                    for name in self.state_params)
+
+    def _marker(self):
+        return self.marker(self.info, self.state_fields)
+
+    @staticmethod
+    def marker(info, fields):
+        """Returns the last modification time of the object info, or
+        a digest of its fields if LogicMonitor doesn't report one"""
+        if info.get("updatedOn") is not None:
+            return info["updatedOn"]
+
+        fields = dict((name, info.get(name)) for name in fields)
+        return hashlib.sha1(json.dumps(fields, sort_keys=True,
+                                       default=str)).hexdigest()
+
+    def set_group_ids(self, h, groups, ids=None):
+        """Create any missing groups in the list of paths groups
+        and set the host hash h to place the host in them. ids may
+        hold the ids of groups already known by normalized path.
+        Does nothing if groups is None"""
+        if groups is not None:
+            ids = dict(ids or {})
+            unknown = [group for group in groups
+                       if self._normalize_path(group) not in ids]
+
+            if unknown:
+                for group, groupid in self.ensure_groups(unknown).items():
+                    ids[self._normalize_path(group)] = groupid
+
+            h["hostGroupIds"] = ",".join(
+                str(ids[self._normalize_path(group)]) for group in groups)
+
+    def apply_operation(self, op, ids=None):
+        """Carry out a single operation of a plan. Objects
+        are checked against the marker recorded when the
+        plan was made before they are updated, and objects
+        to be added are skipped if they already exist. ids
+        may hold the ids of groups already known by
+        normalized path"""
+        logging.debug("Applying {0} {1}".format(op["op"], op.get("key")))
+        h = dict(op.get("params", {}))
+
+        if op["op"] == "createGroups":
+            self.ensure_groups(op["fullpaths"])
+            return
+        elif op["op"] == "addHost":
+            info = self.get_host_by_displayname(op["key"])
+
+            if info is None:
+                info = self.get_host_by_hostname(h["hostName"],
+                                                 {"id": h["agentId"]})
+
+            if info is not None:
+                # An earlier apply of the same plan added it
+                if (info.get("hostName") != h["hostName"] or
+                   info.get("displayedAs") != h["displayedAs"] or
+                   info.get("agentId") != h["agentId"]):
+                    self.fail(msg="Error: Host {0} has changed since the "
+                                  "plan was made".format(op["key"]))
+
+                logging.debug("Host {0} already added".format(op["key"]))
+                return
+
+            self.set_group_ids(h, op["groups"], ids)
+        elif op["op"] == "updateHost":
+            info = self.get_host_by_displayname(op["key"])
+
+            if info is None:
+                info = self.get_host_by_hostname(op["hostname"],
+                                                 {"id": op["agentId"]})
+
+            if (info is None or
+               self.marker(info, Host.state_fields) != op["marker"]):
+                self.fail(msg="Error: Host {0} has changed since the plan "
+                              "was made".format(op["key"]))
+
+            self.set_group_ids(h, op["groups"], ids)
+        elif op["op"] == "addHostGroup":
+            if self.get_group(op["key"]) is not None:
+                logging.debug("Group {0} already added".format(op["key"]))
+                return
+
+            parent = op["key"].rsplit("/", 1)[0] or "/"
+            if ids is not None and self._normalize_path(parent) in ids:
+                h["parentId"] = ids[self._normalize_path(parent)]
             else:
-                logging.debug("RPC call failed")
-                self.fail(
-                    msg="Error: unable to create new hostgroup \"{0}\".\n{1}"
-                    .format(name, resp["errmsg"]))
+                h["parentId"] = self.ensure_groups([parent])[parent]
+        elif op["op"] == "updateHostGroup":
+            info = self.get_group(op["key"])
+
+            if (info is None or
+               self.marker(info, Hostgroup.state_fields) != op["marker"]):
+                self.fail(msg="Error: Group {0} has changed since the plan "
+                              "was made".format(op["key"]))
+        else:
+            self.fail(msg="Error: Unexpected operation \"{0}\" in plan"
+                      .format(op["op"]))
+
+        logging.debug("Making RPC call to '{0}'".format(op["op"]))
+        resp = self.rpc(op["op"], h)
+
+        if resp.status == 200:
+            logging.debug("RPC call succeeded")
+            self.change = True
+        else:
+            logging.debug("RPC call failed")
+            self.fail(msg="Error: {0} {1} failed.\n{2}"
+                      .format(op["op"], op["key"], resp.errmsg))
+
+    @staticmethod
+    def describe_operation(op):
+        """Returns op without any property values
+        for the module result"""
+        return dict((name, value) for name, value in op.items()
+                    if name not in ("params", "marker"))
+
+    def _resolve_properties(self, propresp, ignore):
+        """Returns a hash of the properties in propresp, replacing
+        masked values verified to match with the supplied value"""
+        p = {}
+
+        # Verify all masked values with a single request
+        verified = self._verify_properties(
+            [prop["name"] for prop in propresp
+             if prop["name"] not in ignore and "*******" in prop["value"]])
+
+        logging.debug("Creating list of properties")
+        for prop in propresp:
+            if prop["name"] not in ignore:
+                if verified.get(prop["name"]):
+                    p[prop["name"]] = self.properties[prop["name"]]
+                else:
+                    p[prop["name"]] = prop["value"]
+
+        return p
+
+    def _verify_batch(self, target, properties):
+        """Verify properties with a single verifyProperties call,
+        splitting the batch when some of the values don't match"""
+        if not properties:
+            return {}
+
+        names = sorted(properties)
+        h = dict(target)
+        for num, name in enumerate(names):
+            h["propName{0}".format(num)] = name
+            h["propValue{0}".format(num)] = properties[name]
+
+        logging.debug("Making RPC call to 'verifyProperties' for {0}"
+                      .format(", ".join(names)))
+        resp = self.rpc("verifyProperties", h)
+
+        if resp.status != 200:
+            self.fail(
+                msg="Error: unable to get verification " +
+                    "from server.\n%s" % resp.errmsg)
+            return {}
+
+        logging.debug("RPC call succeeded")
+        match = resp.data["match"]
+
+        if match or len(names) == 1:
+            return dict((name, bool(match)) for name in names)
+
+        # The server only reports whether every value matched. Split
+        # the batch to find out which ones didn't.
+        logging.debug("Narrowing down mismatched properties")
+        half = len(names) // 2
+        result = self._verify_batch(
+            target, dict((name, properties[name]) for name in names[:half]))
+        result.update(self._verify_batch(
+            target, dict((name, properties[name]) for name in names[half:])))
+        return result
+
+    def summary(self):
+        """Returns a hash of run statistics to include in the
+        module result"""
+        summary = {"connections": self.pool.stats(),
+                   "rpc": self.rpc_stats.stats(),
+                   "cache": self.cache.stats(),
+                   "retries": self.limiter.stats()}
+
+        if self.shared_cache is not None:
+            summary["shared_cache"] = self.shared_cache.stats()
+
+        if self.verify_cache is not None:
+            summary["verify_cache"] = self.verify_cache.stats()
+
+        if self.delta is not None:
+            summary["delta"] = self.delta.summary()
+
+        if self.state_store is not None:
+            summary["state_cache"] = self.state_store.stats()
+
+        if self.breaker is not None:
+            summary["circuit"] = self.breaker.stats()
+
+        if self.latency is not None:
+            summary["hedged"] = self.latency.stats()
+
+        return summary
 
     def fail(self, msg):
         logging.warning(msg)
 
-        # Use Ansible module functions if provided
+        # Only the main thread may end the module run, and never
+        # while other objects in a batch are still being handled
+        if self.batch or threading.current_thread().name != "MainThread":
+            raise LogicMonitorError(msg)
+
+        # Use Ansible module functions if provided. They end the run
+        # by raising SystemExit, which must not be caught; without
+        # them the error is raised so that the caller stops anyway
         try:
-            self.module.fail_json(msg=msg, changed=self.change, failed=True)
+            self.module.fail_json(msg=msg, changed=self.change, failed=True,
+                                  **self.summary())
+        except SystemExit:
+            raise
         except:
             logging.debug(msg)
+        raise LogicMonitorError(msg)
 
     def exit(self, changed):
         logging.debug("Changed: {0}".format(changed))
+        logging.debug("Connections: {0}".format(self.pool.stats()))
+
+        if self.batch:
+            raise LogicMonitorExit(changed)
 
         # Use Ansible module functions if provided
         try:
-            self.module.exit_json(changed=changed, success=True)
+            self.module.exit_json(changed=changed, success=True,
+                                  **self.summary())
+        except SystemExit:
+            raise
         except:
             print("Changed: {0}".format(changed))
 
@@ -858,6 +4253,8 @@ class LogicMonitor(object):
         try:
             logging.debug("Registering properties as Ansible facts")
             self.module.exit_json(changed=False, ansible_facts=info)
+        except SystemExit:
+            raise
         except:
             logging.debug("Properties: {0}".format(info))
 
@@ -1272,12 +4669,12 @@ class Collector(LogicMonitor):
 
             # Use user UTC offset
             logging.debug("Making RPC call to 'getTimeZoneSetting'")
-            accountresp = json.loads(self.rpc("getTimeZoneSetting", {}))
+            accountresp = self.rpc("getTimeZoneSetting", {})
 
-            if accountresp["status"] == 200:
+            if accountresp.status == 200:
                 logging.debug("RPC call succeeded")
 
-                offset = accountresp["data"]["offset"]
+                offset = accountresp.data["offset"]
                 offsetstart = start + timedelta(0, offset)
             else:
                 self.fail(msg="Error: Unable to retrieve timezone offset")
@@ -1299,14 +4696,14 @@ class Collector(LogicMonitor):
              "endMinute": offsetend.minute}
 
         logging.debug("Making RPC call to 'setAgentSDT'")
-        resp = json.loads(self.rpc("setAgentSDT", h))
+        resp = self.rpc("setAgentSDT", h)
 
-        if resp["status"] == 200:
+        if resp.status == 200:
             logging.debug("RPC call succeeded")
-            return resp["data"]
+            return resp.data
         else:
             logging.debug("RPC call failed")
-            self.fail(msg=resp["errmsg"])
+            self.fail(msg=resp.errmsg)
 
     def site_facts(self):
         """Output current properties information for the Collector"""
@@ -1354,15 +4751,15 @@ class Collector(LogicMonitor):
                      "description": self.description}
 
                 logging.debug("Making RPC call to 'addAgent'")
-                create = (json.loads(self.rpc("addAgent", h)))
+                create = self.rpc("addAgent", h)
 
-                if create["status"] is 200:
+                if create.status is 200:
                     logging.debug("RPC call succeeded")
-                    self.info = create["data"]
-                    self.id = create["data"]["id"]
-                    return create["data"]
+                    self.info = create.data
+                    self.id = create.data["id"]
+                    return create.data
                 else:
-                    self.fail(msg=create["errmsg"])
+                    self.fail(msg=create.errmsg)
             else:
                 self.info = ret
                 self.id = ret["id"]
@@ -1390,20 +4787,19 @@ class Collector(LogicMonitor):
                 self.exit(changed=True)
 
             logging.debug("Making RPC call to 'deleteAgent'")
-            delete = json.loads(self.rpc("deleteAgent",
-                                         {"id": self.id}))
+            delete = self.rpc("deleteAgent", {"id": self.id})
 
-            if delete["status"] is 200:
+            if delete.status is 200:
                 logging.debug("RPC call succeeded")
                 return delete
             else:
                 # The collector couldn't unregister. Start the service again
                 logging.debug("Error unregistering collecting. {0}"
-                              .format(delete["errmsg"]))
+                              .format(delete.errmsg))
                 logging.debug("The collector service will be restarted")
 
                 self.start()
-                self.fail(msg=delete["errmsg"])
+                self.fail(msg=delete.errmsg)
         else:
             logging.debug("Collector not found")
             return None
@@ -1411,6 +4807,13 @@ class Collector(LogicMonitor):
 
 class Host(LogicMonitor):
 
+    # Parameters making up the desired state of a host and the
+    # fields of the host record which change when it is modified
+    state_params = ["hostname", "displayname", "collector", "description",
+                    "groups", "properties", "alertenable"]
+    state_fields = ["id", "hostName", "displayedAs", "agentId",
+                    "description", "alertEnable", "fullPathInIds"]
+
     def __init__(self, params, module=None):
         """Initializor for the LogicMonitor host object"""
         logging.basicConfig(level=logging.DEBUG)
@@ -1437,10 +4840,19 @@ class Host(LogicMonitor):
                           .format(self.fqdn))
             self.displayname = self.fqdn
 
-        # Attempt to host information via display name of host name
+        # The display name lookup and the collector listing don't depend
+        # on each other, so fetch them concurrently. The listing is kept
+        # in the response cache for get_collector_by_description.
         logging.debug("Attempting to find host by displayname {0}"
                       .format(self.displayname))
-        info = self.get_host_by_displayname(self.displayname)
+        workers = ThreadPool(LOOKUP_WORKERS)
+        try:
+            info = self._gather(
+                [workers.submit(self.get_host_by_displayname,
+                                self.displayname),
+                 workers.submit(self.get_collectors)])[0]
+        finally:
+            workers.shutdown()
 
         if info is not None:
             logging.debug("Host found by displayname")
@@ -1455,7 +4867,8 @@ class Host(LogicMonitor):
             logging.debug("Host not found by displayname")
 
         # At this point, a valid collector description is required for success
-        # Check that the description exists or fail
+        # Check that the description exists or fail. The collector listing
+        # is already cached so this is a local lookup.
         if self.params["collector"]:
             logging.debug("Collector specified is {0}"
                           .format(self.params["collector"]))
@@ -1464,13 +4877,17 @@ class Host(LogicMonitor):
         else:
             self.fail(msg="No collector specified.")
 
-        # If the host wasn't found via displayname, attempt by hostname
+        # If the host wasn't found via displayname, attempt by hostname.
+        # This is the only lookup which needs the collector.
         if info is None:
             logging.debug("Attempting to find host by hostname {0}"
                           .format(self.hostname))
             info = self.get_host_by_hostname(self.hostname, self.collector)
 
+        # Snapshot of the remote host. Properties are fetched the
+        # first time they are needed.
         self.info = info
+        self.remote_properties = None
         self.properties = self.params["properties"]
         self.description = self.params["description"]
         self.starttime = self.params["starttime"]
@@ -1488,26 +4905,46 @@ class Host(LogicMonitor):
 
         self.update()
 
+    def refresh(self):
+        """Re-read the remote state of this host. Only
+        needed after the host has been changed"""
+        logging.debug("Running Host.refresh...")
+
+        info = self.get_host_by_displayname(self.displayname)
+
+        if info is None:
+            info = self.get_host_by_hostname(self.hostname, self.collector)
+
+        self.info = info
+        self.remote_properties = None
+
+    def state_key(self):
+        return "host:{0}".format(self.displayname)
+
     def get_properties(self):
         """Returns a hash of the properties
         associated with this LogicMonitor host"""
         logging.debug("Running Host.get_properties...")
 
+        if self.remote_properties is not None:
+            return self.remote_properties
+
         if self.info:
             logging.debug("Making RPC call to 'getHostProperties'")
-            properties_json = (json.loads(self.rpc("getHostProperties",
-                                          {'hostId': self.info["id"],
-                                           "filterSystemProperties": True})))
+            properties_json = self.rpc("getHostProperties",
+                                       {'hostId': self.info["id"],
+                                        "filterSystemProperties": True})
 
-            if properties_json["status"] == 200:
+            if properties_json.status == 200:
                 logging.debug("RPC call succeeded")
-                return properties_json["data"]
+                self.remote_properties = properties_json.data
+                return properties_json.data
             else:
                 logging.debug("Error: there was an issue retrieving the " +
                               "host properties")
-                logging.debug(properties_json["errmsg"])
+                logging.debug(properties_json.errmsg)
 
-                self.fail(msg=properties_json["status"])
+                self.fail(msg=properties_json.status)
         else:
             logging.debug("Unable to find LogicMonitor host which " +
                           "matches {0} ({1})"
@@ -1550,15 +4987,16 @@ class Host(LogicMonitor):
                 self.alertenable)
 
             logging.debug("Making RPC call to 'addHost'")
-            resp = json.loads(self.rpc("addHost", h))
+            resp = self.rpc("addHost", h)
 
-            if resp["status"] == 200:
+            if resp.status == 200:
                 logging.debug("RPC call succeeded")
-                return resp["data"]
+                self.refresh()
+                return resp.data
             else:
                 logging.debug("RPC call failed")
                 logging.debug(resp)
-                return resp["errmsg"]
+                return resp.errmsg
         elif self.collector is None:
             self.fail(msg="Specified collector doesn't exist")
         else:
@@ -1572,35 +5010,34 @@ class Host(LogicMonitor):
 
         if self.info:
             logging.debug("Host already registed")
-            if self.is_changed():
+            if self.is_current():
+                logging.debug("Supplied state already applied. " +
+                              "No changes to make.")
+                return self.info
+            elif self.is_changed():
                 logging.debug("System changed")
                 self.change = True
 
                 if self.check_mode:
                     self.exit(changed=True)
 
-                h = (self._build_host_hash(
-                     self.hostname,
-                     self.displayname,
-                     self.collector,
-                     self.description,
-                     self.groups,
-                     self.properties,
-                     self.alertenable))
-                h["id"] = self.info["id"]
-                h["opType"] = "replace"
+                h, groups = self._update_hash()
+                self.set_group_ids(h, groups)
 
                 logging.debug("Making RPC call to 'updateHost'")
-                resp = json.loads(self.rpc("updateHost", h))
+                resp = self.rpc("updateHost", h)
 
-                if resp["status"] == 200:
+                if resp.status == 200:
                     logging.debug("RPC call succeeded")
+                    self.refresh()
+                    self.record_state()
                 else:
                     logging.debug("RPC call failed")
                     self.fail(msg="Error: unable to update the host.")
             else:
                 logging.debug("Host properties match supplied properties. " +
                               "No changes to make.")
+                self.record_state()
                 return self.info
         else:
             logging.debug("Host not registed. Registering")
@@ -1610,7 +5047,55 @@ class Host(LogicMonitor):
             if self.check_mode:
                 self.exit(changed=True)
 
-            return self.add()
+            result = self.add()
+            self.record_state()
+            return result
+
+    def plan(self):
+        """Returns the operations needed to make the host match
+        the supplied parameters, without changing anything"""
+        logging.debug("Running Host.plan...")
+
+        if self.collector is None:
+            self.fail(msg="Specified collector doesn't exist")
+
+        operations = []
+
+        index = self.get_group_index()
+        missing = [group for group in self.groups or []
+                   if index is None or index.get(group) is None]
+        if missing:
+            operations.append({"op": "createGroups", "fullpaths": missing})
+
+        if not self.info:
+            logging.debug("Host not registered")
+            h = self._build_host_hash(
+                self.hostname,
+                self.displayname,
+                self.collector,
+                self.description,
+                None,
+                self.properties,
+                self.alertenable)
+
+            operations.append({"op": "addHost",
+                               "key": self.displayname,
+                               "params": h,
+                               "groups": self.groups})
+        elif self.is_changed():
+            logging.debug("Host changed")
+            h, groups = self._update_hash()
+
+            operations.append({"op": "updateHost",
+                               "key": self.displayname,
+                               "hostname": self.hostname,
+                               "agentId": self.collector["id"],
+                               "marker": self._marker(),
+                               "params": h,
+                               "groups": groups,
+                               "delta": self.delta.summary()})
+
+        return operations
 
     def remove(self):
         """Remove this host from your LogicMonitor account"""
@@ -1625,19 +5110,21 @@ class Host(LogicMonitor):
                 self.exit(changed=True)
 
             logging.debug("Making RPC call to 'deleteHost'")
-            resp = json.loads(self.rpc("deleteHost",
-                                       {"hostId": self.info["id"],
-                                        "deleteFromSystem": True,
-                                        "hostGroupId": 1}))
+            resp = self.rpc("deleteHost",
+                            {"hostId": self.info["id"],
+                             "deleteFromSystem": True,
+                             "hostGroupId": 1})
 
-            if resp["status"] == 200:
+            if resp.status == 200:
                 logging.debug(resp)
                 logging.debug("RPC call succeeded")
+                if self.state_store is not None:
+                    self.state_store.forget(self.state_key())
                 return resp
             else:
                 logging.debug("RPC call failed")
                 logging.debug(resp)
-                self.fail(msg=resp["errmsg"])
+                self.fail(msg=resp.errmsg)
 
         else:
             logging.debug("Host not registered")
@@ -1647,44 +5134,54 @@ class Host(LogicMonitor):
         match the LogicMonitor account"""
         logging.debug("Running Host.is_changed")
 
-        ignore = ['system.categories', 'snmp.version']
+        self.delta = self.diff()
+        return bool(self.delta)
 
-        hostresp = self.get_host_by_displayname(self.displayname)
+    def diff(self):
+        """Return a Delta of the changes needed to make
+        the host match the supplied parameters"""
+        logging.debug("Running Host.diff")
 
-        if hostresp is None:
-            hostresp = self.get_host_by_hostname(self.hostname, self.collector)
+        ignore = ['system.categories', 'snmp.version']
 
-        if hostresp:
-            logging.debug("Comparing simple host properties")
-            if hostresp["alertEnable"] != self.alertenable:
-                return True
+        # Compare against the snapshot taken when this object was built
+        hostresp = self.info
 
-            if hostresp["description"] != self.description:
-                return True
+        if hostresp:
+            delta = Delta()
 
-            if hostresp["displayedAs"] != self.displayname:
-                return True
+            logging.debug("Comparing simple host properties")
+            delta.compare("alertEnable",
+                          hostresp["alertEnable"],
+                          self.alertenable)
+            delta.compare("description",
+                          hostresp["description"],
+                          self.description)
+            delta.compare("displayedAs",
+                          hostresp["displayedAs"],
+                          self.displayname)
 
             if (self.collector and
-               hasattr(self.collector, "id") and
-               hostresp["agentId"] != self.collector["id"]):
-                return True
+               hasattr(self.collector, "id")):
+                delta.compare("agentId",
+                              hostresp["agentId"],
+                              self.collector["id"])
 
             logging.debug("Comparing groups.")
-            if self._compare_groups(hostresp) is True:
-                return True
+            self._compare_groups(hostresp, delta)
 
             propresp = self.get_properties()
 
-            if propresp:
+            if propresp is not None:
                 logging.debug("Comparing properties.")
-                if self._compare_props(propresp, ignore) is True:
-                    return True
+                delta.compare_properties(
+                    self._resolve_properties(propresp, ignore),
+                    self.properties)
             else:
                 self.fail(
                     msg="Error: Unknown error retrieving host properties")
 
-            return False
+            return delta
         else:
             self.fail(msg="Error: Unknown error retrieving host information")
 
@@ -1713,12 +5210,12 @@ class Host(LogicMonitor):
 
                 # Use user UTC offset
                 logging.debug("Making RPC call to 'getTimeZoneSetting'")
-                accountresp = (json.loads(self.rpc("getTimeZoneSetting", {})))
+                accountresp = self.rpc("getTimeZoneSetting", {})
 
-                if accountresp["status"] == 200:
+                if accountresp.status == 200:
                     logging.debug("RPC call succeeded")
 
-                    offset = accountresp["data"]["offset"]
+                    offset = accountresp.data["offset"]
                     offsetstart = start + timedelta(0, offset)
                 else:
                     self.fail(
@@ -1740,14 +5237,14 @@ class Host(LogicMonitor):
                  "endMinute": offsetend.minute}
 
             logging.debug("Making RPC call to 'setHostSDT'")
-            resp = (json.loads(self.rpc("setHostSDT", h)))
+            resp = self.rpc("setHostSDT", h)
 
-            if resp["status"] == 200:
+            if resp.status == 200:
                 logging.debug("RPC call succeeded")
-                return resp["data"]
+                return resp.data
             else:
                 logging.debug("RPC call failed")
-                self.fail(msg=resp["errmsg"])
+                self.fail(msg=resp.errmsg)
         else:
             self.fail(msg="Error: Host doesn't exit.")
 
@@ -1792,12 +5289,10 @@ class Host(LogicMonitor):
 
         if groups is not None and groups is not []:
             logging.debug("Group property exists")
-            groupids = ""
+            groupids = self.ensure_groups(groups)
 
-            for group in groups:
-                groupids = groupids + str(self.create_group(group)) + ","
-
-            h["hostGroupIds"] = groupids.rstrip(',')
+            h["hostGroupIds"] = ",".join(
+                str(groupids[group]) for group in groups)
 
         if properties is not None and properties is not {}:
             logging.debug("Properties hash exists")
@@ -1809,97 +5304,107 @@ class Host(LogicMonitor):
 
         return h
 
-    def _verify_property(self, propname):
-        """Check with LogicMonitor server to
-        verify property is unchanged"""
-        logging.debug("Running Host._verify_property...")
+    def _update_hash(self):
+        """Return the updateHost hash applying self.delta, without
+        group ids, and the group paths it must set or None"""
+        # Host properties which aren't listed are always kept, so only
+        # those which changed are sent. opType only applies to the
+        # properties; the full list of groups sets the memberships
+        groups = self.groups
+        properties = self.delta.properties()
+        self.delta.optype = "add"
+
+        h = (self._build_host_hash(
+             self.hostname,
+             self.displayname,
+             self.collector,
+             self.description,
+             None,
+             properties,
+             self.alertenable))
+        h["id"] = self.info["id"]
+        h["opType"] = self.delta.optype
+
+        return h, groups
+
+    def _verify_properties(self, propnames):
+        """Check with LogicMonitor server to verify which
+        properties are unchanged. Returns a hash of each
+        property name to whether it matches"""
+        logging.debug("Running Host._verify_properties...")
 
         if self.info:
             logging.debug("Host is registered")
-            if propname not in self.properties:
-                logging.debug("Property {0} does not exist".format(propname))
-                return False
-            else:
-                logging.debug("Property {0} exists".format(propname))
-                h = {"hostId": self.info["id"],
-                     "propName0": propname,
-                     "propValue0": self.properties[propname]}
-
-                logging.debug("Making RCP call to 'verifyProperties'")
-                resp = json.loads(self.rpc('verifyProperties', h))
-
-                if resp["status"] == 200:
-                    logging.debug("RPC call succeeded")
-                    return resp["data"]["match"]
+            values = {}
+            result = {}
+
+            for propname in propnames:
+                if propname not in self.properties:
+                    logging.debug("Property {0} does not exist"
+                                  .format(propname))
+                    result[propname] = False
                 else:
-                    self.fail(
-                        msg="Error: unable to get verification " +
-                            "from server.\n%s" % resp["errmsg"])
+                    values[propname] = self.properties[propname]
+
+            result.update(self.verify_properties(
+                {"hostId": self.info["id"]}, values))
+            return result
         else:
             self.fail(
                 msg="Error: Host doesn't exist. Unable to verify properties")
 
-    def _compare_groups(self, hostresp):
-        """Function to compare the host's current
-        groups against provided groups"""
+    def _compare_groups(self, hostresp, delta):
+        """Function to record the differences between the
+        host's current groups and provided groups in delta"""
         logging.debug("Running Host._compare_groups")
 
         g = []
+        index = self.get_group_index()
         fullpathinids = hostresp["fullPathInIds"]
-        logging.debug("Building list of groups")
+        logging.debug("Building list of static groups")
         for path in fullpathinids:
             if path != []:
-                h = {'hostGroupId': path[-1]}
+                group = None
+                if index is not None:
+                    group = index.by_id.get(path[-1])
 
-                hgresp = json.loads(self.rpc("getHostGroup", h))
+                # Only look up groups the listing doesn't describe
+                if group is None or "appliesTo" not in group:
+                    h = {'hostGroupId': path[-1]}
 
-                if (hgresp["status"] == 200
-                   and hgresp["data"]["appliesTo"] == ""):
+                    hgresp = self.rpc("getHostGroup", h)
 
+                    if hgresp.status != 200:
+                        continue
+                    group = hgresp.data
+
+                if group["appliesTo"] == "":
                     g.append(path[-1])
 
         if self.groups is not None:
             logging.debug("Comparing group lists")
             for group in self.groups:
-                groupjson = self.get_group(group)
+                groupjson = index.get(group) if index is not None else None
 
                 if groupjson is None:
                     logging.debug("Group mismatch. No result.")
-                    return True
+                    delta.groups_added.append(group)
                 elif groupjson['id'] not in g:
                     logging.debug("Group mismatch. ID doesn't exist.")
-                    return True
+                    delta.groups_added.append(group)
                 else:
                     g.remove(groupjson['id'])
 
-            if g != []:
+            for groupid in g:
                 logging.debug("Group mismatch. New ID exists.")
-                return True
-            logging.debug("Groups match")
-
-    def _compare_props(self, propresp, ignore):
-        """Function to compare the host's current
-        properties against provided properties"""
-        logging.debug("Running Host._compare_props...")
-        p = {}
+                groupjson = (index.by_id.get(groupid)
+                             if index is not None else None)
 
-        logging.debug("Creating list of properties")
-        for prop in propresp:
-            if prop["name"] not in ignore:
-                if ("*******" in prop["value"]
-                   and self._verify_property(prop["name"])):
-                    p[prop["name"]] = self.properties[prop["name"]]
+                if groupjson is not None:
+                    delta.groups_removed.append(
+                        "/" + groupjson["fullPath"])
                 else:
-                    p[prop["name"]] = prop["value"]
-
-        logging.debug("Comparing properties")
-        # Iterate provided properties and compare to received properties
-        for prop in self.properties:
-            if (prop not in p or
-               p[prop] != self.properties[prop]):
-                logging.debug("Properties mismatch")
-                return True
-        logging.debug("Properties match")
+                    delta.groups_removed.append(str(groupid))
 
     def _strip_groups(self, groups):
         """Function to strip whitespace from group list.
@@ -1911,6 +5416,12 @@ class Host(LogicMonitor):
 
 class Hostgroup(LogicMonitor):
 
+    # Parameters making up the desired state of a group and the
+    # fields of the group record which change when it is modified
+    state_params = ["fullpath", "description", "properties", "alertenable"]
+    state_fields = ["id", "fullPath", "description", "alertEnable",
+                    "appliesTo"]
+
     def __init__(self, params, module=None):
         """Initializor for the LogicMonitor host object"""
         logging.basicConfig(level=logging.DEBUG)
@@ -1920,8 +5431,11 @@ class Hostgroup(LogicMonitor):
 
         LogicMonitor.__init__(self, module, **self.params)
 
+        # Snapshot of the remote group. Properties are fetched the
+        # first time they are needed.
         self.fullpath = self.params["fullpath"]
         self.info = self.get_group(self.fullpath)
+        self.remote_properties = None
         self.properties = self.params["properties"]
         self.description = self.params["description"]
         self.starttime = self.params["starttime"]
@@ -1933,26 +5447,42 @@ class Hostgroup(LogicMonitor):
         logging.debug("Running Hostgroup.create...")
         self.update()
 
+    def refresh(self):
+        """Re-read the remote state of this group. Only
+        needed after the group has been changed"""
+        logging.debug("Running Hostgroup.refresh...")
+
+        self.info = self.get_group(self.fullpath)
+        self.remote_properties = None
+
+    def state_key(self):
+        return "hostgroup:{0}".format(self.fullpath)
+
     def get_properties(self, final=False):
         """Returns a hash of the properties
         associated with this LogicMonitor host"""
         logging.debug("Running Hostgroup.get_properties...")
 
+        if not final and self.remote_properties is not None:
+            return self.remote_properties
+
         if self.info:
             logging.debug("Group found")
 
             logging.debug("Making RPC call to 'getHostGroupProperties'")
-            properties_json = json.loads(self.rpc(
+            properties_json = self.rpc(
                 "getHostGroupProperties",
                 {'hostGroupId': self.info["id"],
-                 "finalResult": final}))
+                 "finalResult": final})
 
-            if properties_json["status"] == 200:
+            if properties_json.status == 200:
                 logging.debug("RPC call succeeded")
-                return properties_json["data"]
+                if not final:
+                    self.remote_properties = properties_json.data
+                return properties_json.data
             else:
                 logging.debug("RPC call failed")
-                self.fail(msg=properties_json["status"])
+                self.fail(msg=properties_json.status)
         else:
             logging.debug("Group not found")
             return None
@@ -1985,7 +5515,7 @@ class Hostgroup(LogicMonitor):
                 self.exit(changed=True)
 
             self.create_group(self.fullpath)
-            self.info = self.get_group(self.fullpath)
+            self.refresh()
 
             logging.debug("Group created")
             return self.info
@@ -1999,37 +5529,36 @@ class Hostgroup(LogicMonitor):
         logging.debug("Running Hostgroup.update")
 
         if self.info:
-            if self.is_changed():
+            if self.is_current():
+                logging.debug("Supplied state already applied. " +
+                              "No changes to make")
+                return self.info
+            elif self.is_changed():
                 logging.debug("System changed")
                 self.change = True
 
                 if self.check_mode:
                     self.exit(changed=True)
 
-                h = self._build_host_group_hash(
-                    self.fullpath,
-                    self.description,
-                    self.properties,
-                    self.alertenable)
-                h["opType"] = "replace"
-
-                if self.fullpath != "/":
-                    h["id"] = self.info["id"]
+                h = self._update_hash()
 
                 logging.debug("Making RPC call to 'updateHostGroup'")
-                resp = json.loads(self.rpc("updateHostGroup", h))
+                resp = self.rpc("updateHostGroup", h)
 
-                if resp["status"] == 200:
+                if resp.status == 200:
                     logging.debug("RPC call succeeded")
-                    return resp["data"]
+                    self.refresh()
+                    self.record_state()
+                    return resp.data
                 else:
                     logging.debug("RPC call failed")
                     self.fail(
                         msg="Error: Unable to update the " +
-                            "host.\n{0}".format(resp["errmsg"]))
+                            "host.\n{0}".format(resp.errmsg))
             else:
                 logging.debug("Group properties match supplied properties. " +
                               "No changes to make")
+                self.record_state()
                 return self.info
         else:
             logging.debug("Group doesn't exist. Creating.")
@@ -2040,7 +5569,47 @@ class Hostgroup(LogicMonitor):
             if self.check_mode:
                 self.exit(changed=True)
 
-            return self.add()
+            result = self.add()
+            self.record_state()
+            return result
+
+    def plan(self):
+        """Returns the operations needed to make the group match
+        the supplied parameters, without changing anything"""
+        logging.debug("Running Hostgroup.plan...")
+
+        operations = []
+
+        if self.info is None:
+            logging.debug("Group doesn't exist")
+            parent = self.fullpath.rsplit("/", 1)[0] or "/"
+
+            if parent != "/" and self.get_group(parent) is None:
+                operations.append({"op": "createGroups",
+                                   "fullpaths": [parent]})
+
+            # The parent is looked up when the plan is applied
+            h = self._build_host_group_hash(
+                self.fullpath,
+                self.description,
+                self.properties,
+                self.alertenable,
+                0)
+            del h["parentID"]
+
+            operations.append({"op": "addHostGroup",
+                               "key": self.fullpath,
+                               "params": h})
+        elif self.is_changed():
+            logging.debug("Group changed")
+
+            operations.append({"op": "updateHostGroup",
+                               "key": self.fullpath,
+                               "marker": self._marker(),
+                               "params": self._update_hash(),
+                               "delta": self.delta.summary()})
+
+        return operations
 
     def remove(self):
         """Idempotent function to ensure the host group
@@ -2056,19 +5625,20 @@ class Hostgroup(LogicMonitor):
                 self.exit(changed=True)
 
             logging.debug("Making RPC call to 'deleteHostGroup'")
-            resp = json.loads(self.rpc("deleteHostGroup",
-                                       {"hgId": self.info["id"]}))
+            resp = self.rpc("deleteHostGroup", {"hgId": self.info["id"]})
 
-            if resp["status"] == 200:
+            if resp.status == 200:
                 logging.debug(resp)
                 logging.debug("RPC call succeeded")
+                if self.state_store is not None:
+                    self.state_store.forget(self.state_key())
                 return resp
-            elif resp["errmsg"] == "No such group":
+            elif resp.errmsg == "No such group":
                 logging.debug("Group doesn't exist")
             else:
                 logging.debug("RPC call failed")
                 logging.debug(resp)
-                self.fail(msg=resp["errmsg"])
+                self.fail(msg=resp.errmsg)
         else:
             logging.debug("Group doesn't exist")
 
@@ -2077,36 +5647,39 @@ class Hostgroup(LogicMonitor):
         the LogicMonitor account"""
         logging.debug("Running Hostgroup.is_changed...")
 
+        self.delta = self.diff()
+        return bool(self.delta)
+
+    def diff(self):
+        """Return a Delta of the changes needed to make
+        the group match the supplied parameters"""
+        logging.debug("Running Hostgroup.diff...")
+
         ignore = []
-        group = self.get_group(self.fullpath)
+        delta = Delta()
+
+        # Compare against the snapshot taken when this object was built
+        group = self.info
         properties = self.get_properties()
 
         if properties is not None and group is not None:
             logging.debug("Comparing simple group properties")
-            if (group["alertEnable"] != self.alertenable
-               or group["description"] != self.description):
-
-                return True
-
-            p = {}
-
-            logging.debug("Creating list of properties")
-            for prop in properties:
-                if prop["name"] not in ignore:
-                    if ("*******" in prop["value"]
-                       and self._verify_property(prop["name"])):
-
-                        p[prop["name"]] = (
-                            self.properties[prop["name"]])
-                    else:
-                        p[prop["name"]] = prop["value"]
+            delta.compare("alertEnable",
+                          group["alertEnable"],
+                          self.alertenable)
+            delta.compare("description",
+                          group["description"],
+                          self.description)
 
             logging.debug("Comparing properties")
-            if set(p) != set(self.properties):
-                return True
+            delta.compare_properties(
+                self._resolve_properties(properties, ignore),
+                self.properties,
+                prune=True)
         else:
             logging.debug("No property information received")
-            return False
+
+        return delta
 
     def sdt(self, duration=30, starttime=None):
         """Create a scheduled down time
@@ -2133,12 +5706,12 @@ class Hostgroup(LogicMonitor):
 
             # Use user UTC offset
             logging.debug("Making RPC call to 'getTimeZoneSetting'")
-            accountresp = json.loads(self.rpc("getTimeZoneSetting", {}))
+            accountresp = self.rpc("getTimeZoneSetting", {})
 
-            if accountresp["status"] == 200:
+            if accountresp.status == 200:
                 logging.debug("RPC call succeeded")
 
-                offset = accountresp["data"]["offset"]
+                offset = accountresp.data["offset"]
                 offsetstart = start + timedelta(0, offset)
             else:
                 self.fail(
@@ -2160,14 +5733,14 @@ class Hostgroup(LogicMonitor):
              "endMinute": offsetend.minute}
 
         logging.debug("Making RPC call to setHostGroupSDT")
-        resp = json.loads(self.rpc("setHostGroupSDT", h))
+        resp = self.rpc("setHostGroupSDT", h)
 
-        if resp["status"] == 200:
+        if resp.status == 200:
             logging.debug("RPC call succeeded")
-            return resp["data"]
+            return resp.data
         else:
             logging.debug("RPC call failed")
-            self.fail(msg=resp["errmsg"])
+            self.fail(msg=resp.errmsg)
 
     def site_facts(self):
         """Output current properties information for the Hostgroup"""
@@ -2185,7 +5758,8 @@ class Hostgroup(LogicMonitor):
                                fullpath,
                                description,
                                properties,
-                               alertenable):
+                               alertenable,
+                               parentid=None):
         """Return a property formated hash for the
         creation of a hostgroup using the rpc function"""
         logging.debug("Running Hostgroup._build_host_hash")
@@ -2196,6 +5770,9 @@ class Hostgroup(LogicMonitor):
         if fullpath == "/":
             logging.debug("Group is root")
             h["id"] = 1
+        elif parentid is not None:
+            h["name"] = fullpath.rsplit('/', 1)[1]
+            h["parentID"] = parentid
         else:
             logging.debug("Determining group path")
             parentpath, name = fullpath.rsplit('/', 1)
@@ -2224,32 +5801,50 @@ class Hostgroup(LogicMonitor):
 
         return h
 
-    def _verify_property(self, propname):
-        """Check with LogicMonitor server
-        to verify property is unchanged"""
-        logging.debug("Running Hostgroup._verify_property")
+    def _update_hash(self):
+        """Return the updateHostGroup hash applying self.delta"""
+        if self.delta.additive():
+            # Only send what changed; everything else is kept
+            properties = self.delta.properties()
+            self.delta.optype = "add"
+        else:
+            properties = self.properties
+            self.delta.optype = "replace"
 
-        if self.info:
-            logging.debug("Group exists")
-            if propname not in self.properties:
-                logging.debug("Property {0} does not exist".format(propname))
-                return False
-            else:
-                logging.debug("Property {0} exists".format(propname))
-                h = {"hostGroupId": self.info["id"],
-                     "propName0": propname,
-                     "propValue0": self.properties[propname]}
+        h = self._build_host_group_hash(
+            self.fullpath,
+            self.description,
+            properties,
+            self.alertenable)
+        h["opType"] = self.delta.optype
 
-                logging.debug("Making RCP call to 'verifyProperties'")
-                resp = json.loads(self.rpc('verifyProperties', h))
+        if self.fullpath != "/":
+            h["id"] = self.info["id"]
 
-                if resp["status"] == 200:
-                    logging.debug("RPC call succeeded")
-                    return resp["data"]["match"]
+        return h
+
+    def _verify_properties(self, propnames):
+        """Check with LogicMonitor server to verify which
+        properties are unchanged. Returns a hash of each
+        property name to whether it matches"""
+        logging.debug("Running Hostgroup._verify_properties")
+
+        if self.info:
+            logging.debug("Group exists")
+            values = {}
+            result = {}
+
+            for propname in propnames:
+                if propname not in self.properties:
+                    logging.debug("Property {0} does not exist"
+                                  .format(propname))
+                    result[propname] = False
                 else:
-                    self.fail(
-                        msg="Error: unable to get verification " +
-                            "from server.\n%s" % resp["errmsg"])
+                    values[propname] = self.properties[propname]
+
+            result.update(self.verify_properties(
+                {"hostGroupId": self.info["id"]}, values))
+            return result
         else:
             self.fail(
                 msg="Error: Group doesn't exist. Unable to verify properties")
@@ -2259,6 +5854,22 @@ def selector(module):
     """Figure out which object and which actions
     to take given the right parameters"""
 
+    if (module.params["action"].lower() in ["plan", "apply"] and
+       not module.params["plan_file"]):
+        module.fail_json(
+            msg="Parameter 'plan_file' required for action '{0}'"
+            .format(module.params["action"]))
+
+    if module.params["action"].lower() == "apply":
+        return apply_selector(module)
+
+    if module.params["hosts"]:
+        if module.params["target"] != "host":
+            module.fail_json(
+                msg="Parameter 'hosts' is only supported for target 'host'")
+
+        return batch_selector(module)
+
     if module.params["target"] == "collector":
         target = Collector(module.params, module)
     elif module.params["target"] == "host":
@@ -2290,13 +5901,328 @@ def selector(module):
         action = target.sdt
     elif module.params["action"].lower() == "update":
         action = target.update
+    elif module.params["action"].lower() == "plan":
+        if module.params["target"] == "collector":
+            module.fail_json(
+                msg="Action 'plan' isn't supported for target 'collector'")
+
+        return write_plan(module, target, target.plan())
     else:
         errmsg = ("Error: Unexpected action \"{0}\" was specified."
                   .format(module.params["action"]))
         module.fail_json(msg=errmsg)
 
     action()
-    module.exit_json(changed=target.change)
+    module.exit_json(changed=target.change, **target.summary())
+
+
+def host_params(spec):
+    """Returns the parameters of a host in a batch with the types
+    AnsibleModule gives the task's own. Raises LogicMonitorError
+    if a value can't be converted"""
+    spec = dict(spec)
+
+    groups = spec.get("groups")
+    if isinstance(groups, basestring):
+        spec["groups"] = groups.split(",") if groups else []
+    elif groups is not None and not isinstance(groups, list):
+        raise LogicMonitorError(
+            "Error: Parameter 'groups' must be a list")
+
+    properties = spec.get("properties")
+    if properties is not None and not isinstance(properties, dict):
+        raise LogicMonitorError(
+            "Error: Parameter 'properties' must be a hash")
+
+    if "alertenable" in spec:
+        value = spec["alertenable"]
+        if isinstance(value, basestring):
+            value = value.lower()
+        if value in BOOLEANS_TRUE:
+            spec["alertenable"] = True
+        elif value in BOOLEANS_FALSE:
+            spec["alertenable"] = False
+        else:
+            raise LogicMonitorError(
+                "Error: Parameter 'alertenable' must be a boolean")
+
+    return spec
+
+
+def batch_selector(module):
+    """Apply the action to every host in the hosts parameter.
+    Account listings and connections are shared by all of them
+    and up to parallelism hosts are handled at once"""
+    params = dict(module.params)
+    specs = params.pop("hosts")
+    parallelism = max(1, int(params.get("parallelism") or 1))
+
+    for spec in specs:
+        if not isinstance(spec, dict):
+            module.fail_json(
+                msg="Error: Each item in 'hosts' must be a hash")
+
+        unknown = set(spec) - BATCH_PARAMS
+        if unknown:
+            module.fail_json(
+                msg="Error: Unsupported host parameters {0}"
+                .format(", ".join(sorted(unknown))))
+
+        if spec.get("action", "update").lower() not in ["add", "remove",
+                                                        "sdt", "update"]:
+            module.fail_json(
+                msg="Error: Unexpected host action \"{0}\" was specified."
+                .format(spec["action"]))
+
+        if params["action"] == "plan" and "action" in spec:
+            module.fail_json(
+                msg="Error: Hosts can't set their own action with 'plan'")
+
+        if not spec.get("hostname") and not spec.get("displayname"):
+            module.fail_json(
+                msg="Error: Each host requires a hostname or displayname")
+
+    # Fetch the account-wide listings once. Every host is then resolved
+    # from the shared response cache. The host listing is only fetched
+    # if a host can't be found by its display name.
+    account = LogicMonitor(module, **params)
+    account.get_collectors()
+    account.get_group_index()
+
+    def reconcile(spec):
+        hostparams = dict(params)
+        hostparams["batch"] = True
+
+        # Each host is named by its own item, never by the controller
+        result = {"hostname": spec.get("hostname") or spec["displayname"],
+                  "displayname": spec.get("displayname") or spec["hostname"],
+                  "changed": False,
+                  "failed": False}
+        target = None
+
+        try:
+            hostparams.update(host_params(spec))
+            hostparams["hostname"] = result["hostname"]
+            hostparams["displayname"] = result["displayname"]
+
+            if ((hostparams["action"] == "add" or
+                hostparams["displayname"] is None) and
+               hostparams["collector"] is None):
+                raise LogicMonitorError("Parameter 'collector' required.")
+
+            target = Host(hostparams, module)
+            action = hostparams["action"].lower()
+
+            if action == "add":
+                target.create()
+            elif action == "remove":
+                target.remove()
+            elif action == "sdt":
+                target.sdt()
+            elif action == "update":
+                target.update()
+            elif action == "plan":
+                result["operations"] = target.plan()
+            else:
+                raise LogicMonitorError(
+                    "Error: Unexpected action \"{0}\" was specified."
+                    .format(hostparams["action"]))
+
+            result["changed"] = target.change
+        except LogicMonitorExit, e:
+            result["changed"] = e.changed
+        except Exception, e:
+            logging.debug("Host {0} failed. {1}"
+                          .format(result["displayname"] or
+                                  result["hostname"], e))
+            result["failed"] = True
+            result["msg"] = str(e)
+            if target is not None:
+                result["changed"] = target.change
+
+        if target is not None and target.delta is not None:
+            result["delta"] = target.delta.summary()
+
+        return result
+
+    workers = ThreadPool(min(parallelism, len(specs)))
+    try:
+        futures = [workers.submit(reconcile, spec) for spec in specs]
+        results = [future.result() for future in futures]
+    finally:
+        workers.shutdown()
+
+    changed = any(result["changed"] for result in results)
+    failed = [result for result in results if result["failed"]]
+
+    if params["action"] == "plan" and not failed:
+        operations = []
+        for result in results:
+            operations.extend(result["operations"])
+            result["operations"] = [LogicMonitor.describe_operation(op)
+                                    for op in result["operations"]]
+
+        return write_plan(module, account, operations, results=results)
+
+    if failed:
+        module.fail_json(msg="Error: {0} of {1} hosts failed"
+                         .format(len(failed), len(results)),
+                         changed=changed, results=results,
+                         **account.summary())
+
+    module.exit_json(changed=changed, results=results, **account.summary())
+
+
+def write_plan(module, target, operations, **result):
+    """Save operations to plan_file for a later apply
+    action and exit with a description of them"""
+    # Groups needed by several objects only have to be created once
+    fullpaths = []
+    plan = []
+    for op in operations:
+        if op["op"] == "createGroups":
+            fullpaths.extend(fullpath for fullpath in op["fullpaths"]
+                             if fullpath not in fullpaths)
+        else:
+            plan.append(op)
+
+    if fullpaths:
+        plan.insert(0, {"op": "createGroups", "fullpaths": fullpaths})
+
+    plan_file = os.path.expanduser(module.params["plan_file"])
+    logging.debug("Writing {0} operations to {1}"
+                  .format(len(plan), plan_file))
+
+    if not JSONStore(plan_file).write({"version": PLAN_VERSION,
+                                       "company": target.company,
+                                       "operations": plan}):
+        module.fail_json(msg="Error: Unable to write plan to {0}"
+                         .format(plan_file))
+
+    result.update(target.summary())
+    module.exit_json(changed=False,
+                     plan_file=plan_file,
+                     operations=[LogicMonitor.describe_operation(op)
+                                 for op in plan],
+                     **result)
+
+
+def export_metrics(module, ok):
+    """Add the statistics of this run to the
+    Prometheus textfile collector file"""
+    params = module.params
+    path = os.path.expanduser(params["metrics_file"])
+
+    try:
+        MetricsExporter(path).export(
+            LogicMonitor.get_stats(params["company"]),
+            params["target"], params["action"].lower(), ok,
+            time.time() - LogicMonitor._started)
+    except (IOError, OSError), e:
+        logging.debug("Unable to export metrics. {0}".format(e))
+
+
+def start_profiler(module):
+    """Start profiling the module run if the profile_dir parameter
+    or the LOGICMONITOR_PROFILE_DIR environment variable is set.
+    Returns the Profiler, or None"""
+    params = module.params
+    directory = (params.get("profile_dir") or
+                 os.environ.get("LOGICMONITOR_PROFILE_DIR"))
+    if not directory:
+        return None
+
+    memory = (params.get("profile_memory") or
+              os.environ.get("LOGICMONITOR_PROFILE_MEMORY", "") not in
+              ["", "0", "false", "no"])
+
+    # Name the files after what was being done to which object
+    if params.get("hosts"):
+        name = "{0}-hosts".format(len(params["hosts"]))
+    elif params["target"] == "hostgroup":
+        name = params.get("fullpath")
+    elif params["target"] == "host":
+        name = params.get("displayname") or params.get("hostname")
+    else:
+        name = socket.getfqdn()
+
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", "{0}-{1}-{2}-{3}-{4}".format(
+        params["target"], params["action"].lower(), (name or "").strip("/"),
+        datetime.now().strftime("%Y%m%dT%H%M%S"), os.getpid()))
+
+    profiler = Profiler(os.path.expanduser(directory), name, memory)
+    profiler.start()
+    return profiler
+
+
+def apply_selector(module):
+    """Carry out the operations saved in plan_file by
+    an earlier plan action without comparing again"""
+    params = dict(module.params)
+    params["batch"] = True
+    account = LogicMonitor(module, **params)
+
+    plan_file = os.path.expanduser(module.params["plan_file"])
+    plan = JSONStore(plan_file).read()
+
+    if (plan.get("version") != PLAN_VERSION or
+       plan.get("company") != account.company):
+        module.fail_json(msg="Error: {0} isn't a plan for this account"
+                         .format(plan_file))
+
+    # Every group used by the plan is created before the objects
+    # placed in it, and unrelated objects are changed concurrently
+    fullpaths = []
+    for op in plan["operations"]:
+        if op["op"] == "createGroups":
+            fullpaths.extend(op["fullpaths"])
+        elif op["op"] == "addHostGroup":
+            fullpaths.append(op["key"].rsplit("/", 1)[0] or "/")
+        else:
+            fullpaths.extend(op.get("groups") or [])
+
+    scheduler = Scheduler(max(1, int(params.get("parallelism") or 1)))
+    try:
+        ids = account.schedule_groups(scheduler, fullpaths)
+    except LogicMonitorError, e:
+        module.fail_json(msg=str(e), changed=False, **account.summary())
+
+    operations = range(len(plan["operations"]))
+    for num, op in enumerate(plan["operations"]):
+        if op["op"] == "createGroups":
+            deps = [LogicMonitor._normalize_path(fullpath)
+                    for fullpath in op["fullpaths"]]
+        elif op["op"] == "addHostGroup":
+            deps = [LogicMonitor._normalize_path(
+                op["key"].rsplit("/", 1)[0] or "/")]
+        else:
+            deps = [LogicMonitor._normalize_path(fullpath)
+                    for fullpath in op.get("groups") or []]
+
+        if op["op"] == "createGroups":
+            # Done once the groups it lists have been created
+            scheduler.add(num, deps, lambda: None)
+        else:
+            scheduler.add(num, deps, account.apply_operation, op, ids)
+
+    errors = scheduler.run()
+
+    applied = [LogicMonitor.describe_operation(plan["operations"][num])
+               for num in operations if num in scheduler.results]
+
+    if errors:
+        failed = [{"op": plan["operations"][num]["op"],
+                   "key": plan["operations"][num].get("key"),
+                   "msg": str(errors[num])}
+                  for num in operations if num in errors]
+
+        module.fail_json(msg="Error: {0} of {1} operations failed"
+                         .format(len(failed), len(operations)),
+                         changed=account.change, operations=applied,
+                         errors=failed, **account.summary())
+
+    module.exit_json(changed=account.change, operations=applied,
+                     **account.summary())
 
 
 def main():
@@ -2310,6 +6236,8 @@ def main():
 
     ACTIONS = [
         "add",
+        "apply",
+        "plan",
         "remove",
         "sdt",
         "update"]
@@ -2331,12 +6259,49 @@ def main():
             duration=dict(required=False, default=30),
             properties=dict(required=False, default={}, type="dict"),
             groups=dict(required=False, default=[], type="list"),
-            alertenable=dict(required=False, default=True, choices=BOOLEANS)
+            alertenable=dict(required=False, default=True, choices=BOOLEANS),
+            timeout=dict(required=False, default=30, type="int"),
+            rate_limit=dict(required=False, default=0, type="float"),
+            retries=dict(required=False, default=3, type="int"),
+            deadline=dict(required=False, default=0, type="int"),
+            hedge_percentile=dict(required=False, default=0, type="int"),
+            circuit_threshold=dict(required=False, default=0, type="int"),
+            circuit_reset=dict(required=False, default=60, type="int"),
+            cache_ttl=dict(required=False, default=0, type="int"),
+            cache_dir=dict(required=False, default=None),
+            verify_ttl=dict(required=False, default=0, type="int"),
+            state_cache=dict(required=False, default=False, type="bool"),
+            hosts=dict(required=False, default=None, type="list"),
+            parallelism=dict(required=False, default=4, type="int"),
+            plan_file=dict(required=False, default=None),
+            metrics_file=dict(required=False, default=None),
+            profile_dir=dict(required=False, default=None),
+            profile_memory=dict(required=False, default=False, type="bool")
         ),
         supports_check_mode=True
     )
 
-    selector(module)
+    profiler = start_profiler(module)
+    if profiler is None and not module.params["metrics_file"]:
+        return selector(module)
+
+    # Modules finish by raising SystemExit, with status 0 on success
+    ok = False
+    try:
+        selector(module)
+        ok = True
+    except SystemExit, e:
+        ok = not e.code
+        raise
+    finally:
+        if profiler is not None:
+            try:
+                profiler.stop()
+            except (IOError, OSError), e:
+                logging.debug("Unable to write profile. {0}".format(e))
+
+        if module.params["metrics_file"]:
+            export_metrics(module, ok)
 
 
 from ansible.module_utils.basic import *